@@ -1,21 +1,60 @@
 # bot/database/cache.py
+import threading
 import cachetools
 
+class LockedTTLCache(cachetools.TTLCache):
+    """TTLCache с блокировкой (кэши cachetools не потокобезопасны)"""
+    def __init__(self, *args, **kwargs):
+        self._lock = threading.RLock()
+        super().__init__(*args, **kwargs)
+    
+    def __getitem__(self, key):
+        with self._lock:
+            return super().__getitem__(key)
+    
+    def __setitem__(self, key, value):
+        with self._lock:
+            super().__setitem__(key, value)
+    
+    def __delitem__(self, key):
+        with self._lock:
+            super().__delitem__(key)
+    
+    def __contains__(self, key):
+        with self._lock:
+            return super().__contains__(key)
+    
+    def get(self, key, default=None):
+        with self._lock:
+            return super().get(key, default)
+    
+    def clear(self):
+        with self._lock:
+            super().clear()
+
 class SimpleCacheManager:
     """Простой менеджер кэша"""
-    def __init__(self):
-        self._caches = {}
+    def __init__(self, max_caches: int = 64):
+        # Число именованных кэшей ограничено: давно не используемые вытесняются
+        self._caches = cachetools.LRUCache(maxsize=max_caches)
+        # Кэши читаются из потоков to_thread и сбрасываются из таймера записи
+        self._lock = threading.RLock()
     
     def get_cache(self, name: str, ttl: int = 300, maxsize: int = 1000):
         """Получить кэш"""
-        if name not in self._caches:
-            self._caches[name] = cachetools.TTLCache(maxsize=maxsize, ttl=ttl)
-        return self._caches[name]
+        with self._lock:
+            cache = self._caches.get(name)
+            if cache is None:
+                cache = LockedTTLCache(maxsize=maxsize, ttl=ttl)
+                self._caches[name] = cache
+            return cache
     
     def clear_cache(self, name: str):
         """Очистить кэш"""
-        if name in self._caches:
-            self._caches[name].clear()
+        with self._lock:
+            cache = self._caches.get(name)
+        if cache is not None:
+            cache.clear()
 
 # Глобальный экземпляр
 cache_manager = SimpleCacheManager()
\ No newline at end of file
@@ -1,16 +1,260 @@
 import gspread
+from gspread.exceptions import APIError
+from gspread.utils import fill_gaps
 from google.oauth2.service_account import Credentials
 from google.auth.transport.requests import Request
 from datetime import datetime, date
-from typing import List, Dict, Any, Optional
-import pandas as pd
-import cachetools
+from types import MappingProxyType
+from typing import TYPE_CHECKING, List, Dict, Any, Mapping, Optional, Tuple
 from ..utils.validators import validate_date, validate_username
 from ..database.cache import cache_manager
+import atexit
+import copy
+import functools
 import logging
+import random
+import threading
+import time
+
+# pandas и numpy импортируются лениво: они нужны только для итогов и экспорта
+if TYPE_CHECKING:
+    import numpy as np
+    import pandas as pd
 
 logger = logging.getLogger(__name__)
 
+# Время жизни кэша чтения листов (секунды)
+SHEET_CACHE_TTL = 30
+
+# Время жизни кэша итогов за период (секунды)
+TOTALS_CACHE_TTL = 300
+
+# Отложенная запись: задержка перед отправкой (секунды) и порог по числу строк
+WRITE_FLUSH_DELAY = 1.0
+WRITE_FLUSH_ROWS = 500
+# Максимальная задержка повтора после неудачной записи (секунды)
+WRITE_MAX_BACKOFF = 60.0
+
+# Заголовки листов
+HEADERS = {
+    'Участники': ['Username', 'Дата добавления', 'Статус', 'Телеграм ID'],
+    'Посты': ['Номер', 'Название', 'Дата', 'Тип', 'Статус', 'Комментарий'],
+    'Активность': ['ID поста', 'Username', 'Лайк', 'Комментарий', 'Матсуни', 'Время проверки'],
+    'Исключения': ['Username', 'Название поста', 'Причина', 'Дата', 'Активно'],
+    'Итоги': ['Период', 'Username', 'Дней активности', 'Всего матсуни', 'Среднее', 'Рейтинг'],
+    'Настройки': ['Ключ', 'Значение', 'Описание'],
+}
+
+# Типы колонок при экспорте (по умолчанию все значения - строки)
+EXPORT_DTYPES = {
+    'Участники': {'Статус': 'category'},
+    'Посты': {'Тип': 'category', 'Статус': 'category'},
+    'Активность': {'Лайк': 'category', 'Комментарий': 'category', 'Матсуни': 'Int32'},
+    'Итоги': {
+        'Период': 'category',
+        'Дней активности': 'Int32',
+        'Всего матсуни': 'Int32',
+        'Среднее': 'float64',
+        'Рейтинг': 'Int32',
+    },
+    'Исключения': {'Активно': 'category'},
+}
+
+def _apply_dtypes(df: 'pd.DataFrame', dtypes: Dict[str, str]) -> 'pd.DataFrame':
+    """Привести колонки к компактным типам; при ошибке колонка не меняется"""
+    import pandas as pd
+    
+    for column, dtype in dtypes.items():
+        if column not in df.columns:
+            continue
+        try:
+            if dtype == 'category':
+                df[column] = df[column].astype('category')
+                continue
+            
+            # Колонка преобразуется, только если разбираются все непустые ячейки:
+            # иначе значения вроде '1,5' (формат локали) молча превратились бы в NaN
+            blank = df[column].isna() | (df[column].astype(str).str.strip() == '')
+            numeric = pd.to_numeric(df[column].where(~blank), errors='coerce')
+            if numeric[~blank].isna().any():
+                raise ValueError(f"non-numeric values in {column}")
+            df[column] = numeric.astype(dtype)
+        except (TypeError, ValueError):
+            logger.warning(f"Column {column} left as text: cannot convert to {dtype}")
+    return df
+
+class _TokenBucket:
+    """Ограничитель частоты запросов (token bucket)"""
+    
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate  # токенов в секунду
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+    
+    def acquire(self):
+        """Дождаться и забрать один токен"""
+        with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                time.sleep((1 - self._tokens) / self.rate)
+
+# Квота Sheets API - 60 запросов в минуту на пользователя
+_bucket = _TokenBucket(rate=1.0, capacity=10)
+
+# Коды ответов, при которых запрос повторяется
+RETRY_STATUS_CODES = {429, 500, 503}
+# Неидемпотентные запросы повторяются только при 429: после 500/503
+# запись могла быть уже применена, и повтор задвоит строки
+WRITE_RETRY_STATUS_CODES = {429}
+MAX_RETRIES = 5
+
+def _throttled(retry_codes=RETRY_STATUS_CODES):
+    """Ограничение частоты и повтор с экспоненциальной задержкой"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            for attempt in range(MAX_RETRIES):
+                _bucket.acquire()
+                try:
+                    return func(*args, **kwargs)
+                except APIError as e:
+                    code = e.response.status_code
+                    if code not in retry_codes or attempt == MAX_RETRIES - 1:
+                        raise
+                    delay = 2 ** attempt + random.random()
+                    logger.warning(f"Sheets API error {code}, retrying in {delay:.1f}s")
+                    time.sleep(delay)
+        return wrapper
+    return decorator
+
+def _cell_value(value: Any) -> Dict:
+    """Значение ячейки для spreadsheets.batchUpdate (без разбора, как RAW)"""
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return {'userEnteredValue': {'numberValue': value}}
+    return {'userEnteredValue': {'stringValue': str(value)}}
+
+def _append_cells_request(worksheet, rows: List[List]) -> Dict:
+    """Запрос appendCells: дописать строки в конец листа"""
+    return {
+        'appendCells': {
+            'sheetId': worksheet.id,
+            'rows': [{'values': [_cell_value(value) for value in row]} for row in rows],
+            'fields': 'userEnteredValue'
+        }
+    }
+
+# Производные кэши, зависящие от содержимого листа
+DEPENDENT_CACHES = {
+    'Участники': ('members', 'totals'),
+    'Исключения': ('exclusions',),
+    'Активность': ('totals', 'daily_totals'),
+}
+
+class _WriteBuffer:
+    """Буфер добавления строк: записи копятся и уходят одним запросом"""
+    
+    def __init__(self, write, delay: float = WRITE_FLUSH_DELAY, max_rows: int = WRITE_FLUSH_ROWS):
+        self._write = write
+        self._delay = delay
+        self._max_rows = max_rows
+        self._pending: Dict[str, List[List]] = {}
+        self._lock = threading.RLock()
+        self._timer = None
+        self._failures = 0
+        self._retry_at = 0.0
+    
+    def append(self, name: str, rows: List[List]):
+        """Поставить строки в очередь на запись"""
+        with self._lock:
+            self._pending.setdefault(name, []).extend(rows)
+            if sum(len(r) for r in self._pending.values()) >= self._max_rows:
+                self.flush()
+            else:
+                self._schedule()
+    
+    def _schedule(self, delay: float = None):
+        """Запустить таймер отправки, если он еще не запущен"""
+        if self._timer is None:
+            self._timer = threading.Timer(delay or self._delay, self._on_timer)
+            self._timer.daemon = True
+            self._timer.start()
+    
+    def _on_timer(self):
+        with self._lock:
+            self._timer = None
+            self.flush(force=True)
+    
+    def flush(self, name: str = None, force: bool = False, raise_errors: bool = False) -> bool:
+        """Отправить накопленные строки (все или только одного листа)"""
+        with self._lock:
+            # После неудачи повтор ждет таймера, а не каждого чтения
+            if not force and time.monotonic() < self._retry_at:
+                return False
+            
+            if name is None:
+                pending, self._pending = self._pending, {}
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+            elif name in self._pending:
+                pending = {name: self._pending.pop(name)}
+            else:
+                return True
+            
+            if not pending:
+                return True
+            try:
+                self._write(pending)
+                self._failures = 0
+                self._retry_at = 0.0
+                return True
+            except APIError as e:
+                if e.response.status_code in WRITE_RETRY_STATUS_CODES:
+                    # Запрос отклонен до выполнения: строки будут отправлены позже
+                    self._requeue(pending, e)
+                    return False
+                self._drop(pending, e)
+                if raise_errors:
+                    raise
+                return False
+            except Exception as e:
+                # Ошибка соединения так же неоднозначна, как 5xx: запись могла примениться
+                self._drop(pending, e)
+                if raise_errors:
+                    raise
+                return False
+    
+    def _drop(self, pending: Dict[str, List[List]], error: Exception):
+        """Отказаться от строк: повтор не поможет или может их задвоить"""
+        logger.error(f"Dropped writes for {list(pending)}: {error}; rows: {pending}")
+    
+    def pending(self, name: str) -> List[List]:
+        """Строки листа, еще не отправленные в таблицу"""
+        with self._lock:
+            return list(self._pending.get(name, ()))
+    
+    def _requeue(self, pending: Dict[str, List[List]], error: Exception):
+        """Вернуть строки в начало очереди и отложить повтор с нарастающей задержкой"""
+        for sheet, rows in pending.items():
+            self._pending[sheet] = rows + self._pending.get(sheet, [])
+        
+        self._failures += 1
+        delay = min(self._delay * 2 ** self._failures, WRITE_MAX_BACKOFF)
+        self._retry_at = time.monotonic() + delay
+        logger.error(f"Failed to flush writes for {list(pending)}, retrying in {delay:.0f}s: {error}")
+        
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self._schedule(delay)
+
 class GoogleSheetsDB:
     """Улучшенная работа с Google Sheets"""
     
@@ -20,6 +264,9 @@ class GoogleSheetsDB:
         self._client = None
         self._sheet = None
         self._worksheets = {}
+        self._member_row_index = None
+        self._writes = _WriteBuffer(self._append_pending)
+        atexit.register(self._writes.flush, force=True)
         
     @property
     def client(self):
@@ -35,7 +282,7 @@ class GoogleSheetsDB:
                     scopes=scope
                 )
                 self._client = gspread.authorize(creds)
-                self._sheet = self._client.open_by_key(self.sheet_id)
+                self._sheet = self._request(self._client.open_by_key, self.sheet_id)
                 self._load_worksheets()
                 logger.info("Google Sheets client initialized successfully")
             except Exception as e:
@@ -43,9 +290,19 @@ class GoogleSheetsDB:
                 raise
         return self._client
     
+    @_throttled()
+    def _request(self, method, *args, **kwargs):
+        """Вызов Sheets API через ограничитель частоты"""
+        return method(*args, **kwargs)
+    
+    @_throttled(WRITE_RETRY_STATUS_CODES)
+    def _write_request(self, method, *args, **kwargs):
+        """Неидемпотентный вызов Sheets API (без повтора при ошибках сервера)"""
+        return method(*args, **kwargs)
+    
     def _load_worksheets(self):
         """Загрузка всех листов"""
-        worksheets = self._sheet.worksheets()
+        worksheets = self._request(self._sheet.worksheets)
         for ws in worksheets:
             self._worksheets[ws.title] = ws
     
@@ -53,7 +310,7 @@ class GoogleSheetsDB:
         """Получить лист по имени"""
         if name not in self._worksheets and create_if_missing:
             try:
-                ws = self._sheet.add_worksheet(title=name, rows=1000, cols=20)
+                ws = self._write_request(self._sheet.add_worksheet, title=name, rows=1000, cols=20)
                 self._worksheets[name] = ws
                 self._init_worksheet_structure(ws, name)
                 logger.info(f"Created new worksheet: {name}")
@@ -64,43 +321,144 @@ class GoogleSheetsDB:
     
     def _init_worksheet_structure(self, worksheet, name: str):
         """Инициализация структуры листа"""
-        headers = {
-            'Участники': ['Username', 'Дата добавления', 'Статус', 'Телеграм ID'],
-            'Посты': ['Номер', 'Название', 'Дата', 'Тип', 'Статус', 'Комментарий'],
-            'Активность': ['ID поста', 'Username', 'Лайк', 'Комментарий', 'Матсуни', 'Время проверки'],
-            'Исключения': ['Username', 'Название поста', 'Причина', 'Дата', 'Активно'],
-            'Итоги': ['Период', 'Username', 'Дней активности', 'Всего матсуни', 'Среднее', 'Рейтинг'],
-            'Настройки': ['Ключ', 'Значение', 'Описание'],
-        }
-        
-        if name in headers:
-            worksheet.clear()
-            worksheet.append_row(headers[name])
+        if name in HEADERS:
+            self._request(worksheet.clear)
+            self._write_request(worksheet.append_row, HEADERS[name])
             # Форматирование заголовков
-            worksheet.format('A1:Z1', {
+            self._request(worksheet.format, 'A1:Z1', {
                 'textFormat': {'bold': True},
                 'backgroundColor': {'red': 0.9, 'green': 0.9, 'blue': 0.9}
             })
+            self._invalidate(name)
     
-    @cachetools.cached(cache=cache_manager.get_cache('members'))
-    def get_members(self, active_only: bool = True) -> List[Dict]:
-        """Получить всех участников"""
-        ws = self.get_worksheet('Участники')
-        data = ws.get_all_records()
+    def _read_records(self, name: str) -> List[Dict]:
+        """Получить записи листа с кэшированием"""
+        self._writes.flush(name)
+        cache = cache_manager.get_cache(f'ws:{name}', ttl=SHEET_CACHE_TTL)
+        records = cache.get('records')
+        if records is None:
+            records = self._request(self.get_worksheet(name).get_all_records)
+            cache['records'] = records
+        # Копия, чтобы вызывающий код не испортил кэш
+        return [dict(row) for row in records]
+    
+    def _cached_values(self, name: str) -> List[List]:
+        """Значения листа из кэша (только для чтения)"""
+        self._writes.flush(name)
+        cache = cache_manager.get_cache(f'ws:{name}', ttl=SHEET_CACHE_TTL)
+        values = cache.get('values')
+        if values is None:
+            values = self._request(self.get_worksheet(name).get_all_values)
+            cache['values'] = values
+        return values
+    
+    def _header_index(self, name: str) -> Dict[str, int]:
+        """Номера колонок листа по заголовку"""
+        cache = cache_manager.get_cache(f'ws:{name}', ttl=SHEET_CACHE_TTL)
+        index = cache.get('header')
+        if index is None:
+            values = self._cached_values(name)
+            index = {header: i for i, header in enumerate(values[0])} if values else {}
+            cache['header'] = index
+        return index
+    
+    def _read_columns(self, name: str, columns: List[str]) -> Dict[str, 'np.ndarray']:
+        """Получить колонки листа как массивы (без обращения к строкам по имени)"""
+        import numpy as np
+        
+        values = self._cached_values(name)
+        header = self._header_index(name)
+        if header:
+            # Ширина берется по строке заголовка: get_all_values дополняет все строки
+            # до самой широкой, а в header повторяющиеся и пустые имена схлопываются
+            body = np.array(values[1:], dtype=object).reshape(-1, len(values[0]))
+        else:
+            body = np.empty((0, 0), dtype=object)
         
-        members = []
-        for row in data:
-            if active_only and row.get('Статус', 'активен').lower() != 'активен':
-                continue
-            members.append({
+        result = {}
+        for column in columns:
+            i = header.get(column)
+            result[column] = body[:, i] if i is not None else np.full(len(body), None, dtype=object)
+        return result
+    
+    def _invalidate(self, name: str):
+        """Сбросить кэш чтения листа и зависящие от него кэши после записи"""
+        cache_manager.clear_cache(f'ws:{name}')
+        for cache_name in DEPENDENT_CACHES.get(name, ()):
+            cache_manager.clear_cache(cache_name)
+    
+    def _append_pending(self, pending: Dict[str, List[List]]):
+        """Дописать накопленные строки на листы одним запросом"""
+        requests = [
+            _append_cells_request(self.get_worksheet(name), rows)
+            for name, rows in pending.items()
+        ]
+        self._write_request(self._sheet.batch_update, {'requests': requests})
+        
+        # Кэши сбрасываются только после фактической записи
+        for name in pending:
+            self._invalidate(name)
+        if 'Участники' in pending:
+            self._member_row_index = None
+        logger.info(f"Flushed writes: {', '.join(f'{n}={len(r)}' for n, r in pending.items())}")
+    
+    def flush(self, name: str = None) -> bool:
+        """Отправить отложенные записи (все или только одного листа)"""
+        return self._writes.flush(name)
+    
+    def pending_records(self, name: str) -> List[Dict]:
+        """Отложенные строки листа в виде записей (как у get_all_records)"""
+        return [dict(zip(HEADERS[name], row)) for row in self._writes.pending(name)]
+    
+    def _all_members(self) -> Tuple[Mapping[str, Any], ...]:
+        """Все участники (кэшируются как неизменяемый кортеж)"""
+        self._writes.flush('Участники')
+        cache = cache_manager.get_cache('members')
+        members = cache.get('all')
+        if members is not None:
+            return members
+        
+        # Отсутствующие колонки заполняем значениями по умолчанию
+        records = [
+            {
                 'username': row['Username'],
                 'join_date': row['Дата добавления'],
-                'status': row.get('Статус', 'активен'),
+                'status': 'активен' if row.get('Статус') is None else row['Статус'],
                 'telegram_id': row.get('Телеграм ID')
-            })
+            }
+            for row in self._read_records('Участники')
+        ]
         
+        # Записи только для чтения: кэш можно безопасно отдавать без копирования
+        members = tuple(MappingProxyType(record) for record in records)
+        cache['all'] = members
         return members
     
+    def get_members(self, active_only: bool = True) -> Tuple[Mapping[str, Any], ...]:
+        """Получить всех участников"""
+        members = self._all_members()
+        if not active_only:
+            return members
+        return tuple(m for m in members if str(m['status']).lower() == 'активен')
+    
+    def usernames(self) -> frozenset:
+        """Множество username активных участников для быстрой проверки"""
+        self._writes.flush('Участники')
+        cache = cache_manager.get_cache('members')
+        usernames = cache.get('usernames')
+        if usernames is None:
+            usernames = frozenset(m['username'] for m in self.get_members())
+            cache['usernames'] = usernames
+        return usernames
+    
+    def get_members_before_date(self, date_str: str) -> List[str]:
+        """Активные участники, добавленные не позже указанной даты"""
+        # Даты в формате ГГГГ-ММ-ДД сравниваются как строки
+        return [
+            m['username'] for m in self.get_members()
+            if str(m['join_date']) <= date_str
+        ]
+    
     def add_member(self, username: str, join_date: str = None, telegram_id: str = None) -> bool:
         """Добавить участника"""
         validate_username(username)
@@ -110,69 +468,83 @@ class GoogleSheetsDB:
         else:
             validate_date(join_date)
         
-        ws = self.get_worksheet('Участники')
-        ws.append_row([username, join_date, 'активен', telegram_id or ''])
-        
-        # Сброс кэша
-        cache_manager.clear_cache('members')
+        # Пользователь получает подтверждение, поэтому запись отправляется сразу;
+        # ошибка доходит до обработчика
+        self._writes.append('Участники', [[username, join_date, 'активен', telegram_id or '']])
+        self._writes.flush('Участники', force=True, raise_errors=True)
         logger.info(f"Member added: {username}")
         return True
     
+    def _load_member_row_index(self) -> Dict[str, int]:
+        """Построить индекс username -> номер строки на листе Участники"""
+        self._writes.flush('Участники')
+        ws = self.get_worksheet('Участники')
+        index = {}
+        for i, value in enumerate(self._request(ws.col_values, 1)[1:], start=2):  # Пропускаем заголовок
+            index.setdefault(value, i)
+        self._member_row_index = index
+        return index
+    
     def update_member_status(self, username: str, status: str) -> bool:
         """Обновить статус участника"""
-        ws = self.get_worksheet('Участники')
-        data = ws.get_all_values()
+        index = self._member_row_index
+        if index is None or username not in index:
+            # Индекс еще не построен или устарел
+            index = self._load_member_row_index()
         
-        for i, row in enumerate(data[1:], start=2):  # Пропускаем заголовок
-            if row[0] == username:
-                ws.update_cell(i, 3, status)  # Колонка статуса
-                cache_manager.clear_cache('members')
-                logger.info(f"Member {username} status updated to {status}")
-                return True
+        row = index.get(username)
+        if row is None:
+            return False
         
-        return False
+        ws = self.get_worksheet('Участники')
+        self._request(ws.update_cell, row, 3, status)  # Колонка статуса
+        self._invalidate('Участники')
+        logger.info(f"Member {username} status updated to {status}")
+        return True
     
-    @cachetools.cached(cache=cache_manager.get_cache('exclusions'))
-    def get_exclusions(self, post_name: str = None) -> List[Dict]:
-        """Получить исключения"""
-        ws = self.get_worksheet('Исключения')
-        data = ws.get_all_records()
-        
-        exclusions = []
-        for row in data:
-            if row['Активно'].lower() != 'да':
-                continue
-            if post_name and row['Название поста'] != post_name:
-                continue
-            
-            exclusions.append({
+    def _active_exclusions(self) -> Tuple[Mapping[str, Any], ...]:
+        """Все действующие исключения (кэшируются как неизменяемый кортеж)"""
+        self._writes.flush('Исключения')
+        cache = cache_manager.get_cache('exclusions')
+        exclusions = cache.get('all')
+        if exclusions is not None:
+            return exclusions
+        
+        exclusions = tuple(
+            MappingProxyType({
                 'username': row['Username'],
                 'post_name': row['Название поста'],
                 'reason': row['Причина'],
                 'date': row['Дата']
             })
-        
+            for row in self._read_records('Исключения')
+            if row['Активно'].lower() == 'да'
+        )
+        cache['all'] = exclusions
         return exclusions
     
+    def get_exclusions(self, post_name: str = None) -> Tuple[Mapping[str, Any], ...]:
+        """Получить исключения"""
+        exclusions = self._active_exclusions()
+        if not post_name:
+            return exclusions
+        return tuple(ex for ex in exclusions if ex['post_name'] == post_name)
+    
     def add_exclusion(self, username: str, post_name: str, reason: str = '') -> bool:
         """Добавить исключение"""
-        ws = self.get_worksheet('Исключения')
-        ws.append_row([
+        self._writes.append('Исключения', [[
             username,
             post_name,
             reason,
             datetime.now().strftime('%Y-%m-%d'),
             'да'
-        ])
-        
-        cache_manager.clear_cache('exclusions')
+        ]])
+        self._writes.flush('Исключения', force=True, raise_errors=True)
         logger.info(f"Exclusion added: {username} for {post_name}")
         return True
     
     def save_activity(self, post_data: Dict, activities: List[Dict]) -> bool:
         """Сохранить активность по посту"""
-        ws = self.get_worksheet('Активность')
-        
         rows = []
         for activity in activities:
             rows.append([
@@ -184,94 +556,122 @@ class GoogleSheetsDB:
                 datetime.now().strftime('%Y-%m-%d %H:%M:%S')
             ])
         
-        if rows:
-            ws.append_rows(rows)
-        
         # Обновляем статус поста
-        post_ws = self.get_worksheet('Посты')
-        post_ws.append_row([
+        post_row = [
             post_data['id'],
             post_data['name'],
             post_data['date'],
             post_data.get('type', 'обычный'),
             'обработан',
             post_data.get('comment', '')
-        ])
+        ]
         
+        # Активность и статус поста уходят одним запросом сразу, до ответа пользователю
+        if rows:
+            self._writes.append('Активность', rows)
+        self._writes.append('Посты', [post_row])
+        self._writes.flush(force=True, raise_errors=True)
         logger.info(f"Activity saved for post {post_data['id']}: {len(activities)} records")
         return True
     
+    def get_activities(self) -> List[Dict]:
+        """Получить записи листа Активность"""
+        return self._read_records('Активность')
+    
     def calculate_totals(self, start_date: str, end_date: str) -> Dict:
         """Подсчитать итоги за период"""
+        import numpy as np
+        import pandas as pd
+        
         validate_date(start_date)
         validate_date(end_date)
         
-        # Получаем все активности за период
-        ws = self.get_worksheet('Активность')
-        data = ws.get_all_records()
+        # Пока на листе Активность не прибавилось строк, итоги не меняются
+        self._writes.flush('Участники')
+        self._writes.flush('Активность')
+        activity_ws = self.get_worksheet('Активность')
+        activity_rows = len(self._request(activity_ws.col_values, 1))
+        totals_cache = cache_manager.get_cache('totals', ttl=TOTALS_CACHE_TTL)
+        key = (start_date, end_date, activity_rows)
+        cached = totals_cache.get(key)
+        if cached is not None:
+            return copy.deepcopy(cached)
         
-        activities = []
-        for row in data:
-            activity_date = row['Время проверки'].split()[0]
-            if start_date <= activity_date <= end_date:
-                activities.append(row)
+        # Получаем все активности за период
+        df = pd.DataFrame(self._read_columns(
+            'Активность', ['Username', 'Матсуни', 'Время проверки']
+        ))
+        members = pd.DataFrame(self._read_columns(
+            'Участники', ['Username', 'Дата добавления', 'Статус']
+        ))
         
-        # Группируем по участникам
-        members_ws = self.get_worksheet('Участники')
-        members = {row['Username']: row for row in members_ws.get_all_records()}
+        start_day = pd.Timestamp(start_date)
+        end_day = pd.Timestamp(end_date)
         
-        results = {}
-        for activity in activities:
-            username = activity['Username']
-            if username not in members:
-                continue
+        final_results = []
+        if not df.empty and not members.empty:
+            # Дата проверки без времени; некорректные значения отбрасываются
+            df['day'] = pd.to_datetime(
+                df['Время проверки'], format='%Y-%m-%d %H:%M:%S', errors='coerce', cache=True
+            ).dt.normalize()
+            df = df[(df['day'] >= start_day) & (df['day'] <= end_day)]
             
-            if username not in results:
-                results[username] = {
-                    'username': username,
-                    'days_active': set(),
-                    'total_matsuni': 0,
-                    'activities': []
-                }
+            # Учитываем только активность известных участников
+            df = df[df['Username'].isin(members['Username'])]
+            df = df.assign(
+                Матсуни=pd.to_numeric(df['Матсуни'], errors='coerce').fillna(0).astype('int32')
+            )
             
-            activity_date = activity['Время проверки'].split()[0]
-            results[username]['days_active'].add(activity_date)
-            results[username]['total_matsuni'] += int(activity['Матсуни'])
-            results[username]['activities'].append(activity)
-        
-        # Преобразуем в список и сортируем
-        final_results = []
-        for username, data in results.items():
-            days_active = len(data['days_active'])
-            avg_matsuni = data['total_matsuni'] / days_active if days_active > 0 else 0
+            # Группируем по участникам
+            agg = df.groupby('Username', sort=False).agg(
+                days_active=('day', 'nunique'),
+                total_matsuni=('Матсуни', 'sum')
+            )
+            agg['avg_matsuni'] = (agg['total_matsuni'] / agg['days_active']).round(2)
             
-            final_results.append({
-                'username': username,
-                'days_active': days_active,
-                'total_matsuni': data['total_matsuni'],
-                'avg_matsuni': round(avg_matsuni, 2),
-                'join_date': members[username].get('Дата добавления', ''),
-                'status': members[username].get('Статус', 'активен')
-            })
-        
-        # Сортировка по total_matsuni (по убыванию)
-        final_results.sort(key=lambda x: x['total_matsuni'], reverse=True)
-        
-        # Добавляем рейтинг
-        for i, result in enumerate(final_results, 1):
-            result['rank'] = i
+            # Данные участников: при дублях берется последняя строка
+            info = (
+                members.drop_duplicates('Username', keep='last')
+                .set_index('Username')
+                .reindex(columns=['Дата добавления', 'Статус'])
+            )
+            agg = agg.join(info)
+            agg['join_date'] = agg['Дата добавления'].fillna('')
+            agg['status'] = agg['Статус'].fillna('активен')
+            
+            # Сортировка по total_matsuni (по убыванию) и рейтинг
+            # (mergesort устойчив: при равенстве сохраняется порядок появления)
+            agg = agg.sort_values(
+                'total_matsuni', ascending=False, kind='mergesort'
+            ).reset_index()
+            agg['rank'] = np.arange(1, len(agg) + 1, dtype='int32')
+            
+            final_results = agg.rename(columns={'Username': 'username'})[[
+                'username', 'days_active', 'total_matsuni', 'avg_matsuni',
+                'join_date', 'status', 'rank'
+            ]].to_dict('records')
         
         # Сохраняем в лист Итоги
         totals_ws = self.get_worksheet('Итоги')
         period_id = f"{start_date}_{end_date}"
         
-        # Очищаем старые записи для этого периода
-        existing_data = totals_ws.get_all_values()
-        rows_to_keep = [existing_data[0]]  # Заголовок
+        # Ищем старые записи этого периода только по колонке A
+        period_rows = [
+            i for i, value in enumerate(self._request(totals_ws.col_values, 1), start=1)
+            if i > 1 and value == period_id  # Пропускаем заголовок
+        ]
         
-        for row in existing_data[1:]:
-            if len(row) > 0 and row[0] != period_id:
-                rows_to_keep.append(row)
+        # Группируем номера строк в непрерывные диапазоны
+        row_ranges = []
+        for row in period_rows:
+            if row_ranges and row_ranges[-1][1] == row - 1:
+                row_ranges[-1][1] = row
+            else:
+                row_ranges.append([row, row])
+        
+        # Удаляем снизу вверх, чтобы не сдвигать еще не удаленные диапазоны
+        for first, last in reversed(row_ranges):
+            self._write_request(totals_ws.delete_rows, first, last)
         
         # Добавляем новые результаты
         new_rows = []
@@ -285,34 +685,58 @@ class GoogleSheetsDB:
                 result['rank']
             ])
         
-        # Обновляем весь лист
-        totals_ws.clear()
-        totals_ws.update(rows_to_keep + new_rows, value_input_option='RAW')
+        if new_rows:
+            self._write_request(totals_ws.append_rows, new_rows, value_input_option='RAW')
+        self._invalidate('Итоги')
         
-        return {
+        result = {
             'period': f"{start_date} - {end_date}",
-            'total_days': (datetime.strptime(end_date, '%Y-%m-%d') - 
-                          datetime.strptime(start_date, '%Y-%m-%d')).days + 1,
+            'total_days': (end_day - start_day).days + 1,
             'total_members': len(final_results),
             'total_matsuni': sum(r['total_matsuni'] for r in final_results),
             'results': final_results
         }
+        # Вызывающий код дополняет результаты, поэтому в кэше хранится копия
+        totals_cache[key] = copy.deepcopy(result)
+        return result
     
     def export_to_excel(self, period: str = None) -> bytes:
         """Экспорт данных в Excel"""
         import io
+        import pandas as pd
+        
+        # Отложенные строки должны попасть в выгрузку
+        self._writes.flush()
         
         # Создаем Excel writer
         output = io.BytesIO()
         
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
+        sheet_names = ['Участники', 'Посты', 'Активность', 'Итоги', 'Исключения']
+        for sheet_name in sheet_names:
+            self.get_worksheet(sheet_name)
+        
+        # Все листы одним запросом вместо отдельного get_all_values на каждый
+        response = self._request(
+            self._sheet.values_batch_get,
+            ranges=[f"'{sheet_name}'!A:Z" for sheet_name in sheet_names]
+        )
+        value_ranges = response.get('valueRanges', [])
+        
+        with pd.ExcelWriter(
+            output,
+            engine='xlsxwriter',
+            engine_kwargs={'options': {
+                'strings_to_formulas': False,
+                'strings_to_urls': False
+            }}
+        ) as writer:
             # Экспортируем все листы
-            for sheet_name in ['Участники', 'Посты', 'Активность', 'Итоги', 'Исключения']:
-                ws = self.get_worksheet(sheet_name)
-                data = ws.get_all_values()
+            for sheet_name, value_range in zip(sheet_names, value_ranges):
+                data = fill_gaps(value_range.get('values', []))
                 
                 if data:
                     df = pd.DataFrame(data[1:], columns=data[0])
+                    df = _apply_dtypes(df, EXPORT_DTYPES.get(sheet_name, {}))
                     df.to_excel(writer, sheet_name=sheet_name, index=False)
             
             # Добавляем сводный отчет
@@ -1,42 +1,48 @@
 # bot/keyboards/main_menu.py
 from telegram import ReplyKeyboardMarkup
 
+# Клавиатуры неизменяемы, поэтому создаются один раз при импорте
+_MAIN_KB = ReplyKeyboardMarkup([
+    ['➕ Добавить участника', '📋 Список участников'],
+    ['📝 Новый пост', '🧮 Подсчитать итог'],
+    ['⚠️ Добавить исключение', '📤 Экспорт в Excel'],
+    ['❓ Помощь']
+], resize_keyboard=True)
+
+_POST_KB = ReplyKeyboardMarkup([
+    ['✅ Завершить этап', '❌ Отмена']
+], resize_keyboard=True)
+
+_YES_NO_KB = ReplyKeyboardMarkup([
+    ['✅ Да', '❌ Нет']
+], resize_keyboard=True)
+
+_EDIT_KB = ReplyKeyboardMarkup([
+    ['✏️ Исправить', '➕ Добавить'],
+    ['🗑️ Удалить', '🔙 Назад']
+], resize_keyboard=True)
+
+_CALCULATE_KB = ReplyKeyboardMarkup([
+    ['📊 Подробный отчет', '📤 Экспорт в Excel'],
+    ['🔙 Назад']
+], resize_keyboard=True)
+
 def get_main_keyboard():
     """Основная клавиатура"""
-    keyboard = [
-        ['➕ Добавить участника', '📋 Список участников'],
-        ['📝 Новый пост', '🧮 Подсчитать итог'],
-        ['⚠️ Добавить исключение', '📤 Экспорт в Excel'],
-        ['❓ Помощь']
-    ]
-    return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+    return _MAIN_KB
 
 def get_post_keyboard():
     """Клавиатура для постов"""
-    keyboard = [
-        ['✅ Завершить этап', '❌ Отмена']
-    ]
-    return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+    return _POST_KB
 
 def get_yes_no_keyboard():
     """Да/Нет клавиатура"""
-    keyboard = [
-        ['✅ Да', '❌ Нет']
-    ]
-    return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+    return _YES_NO_KB
 
 def get_edit_keyboard():
     """Клавиатура редактирования"""
-    keyboard = [
-        ['✏️ Исправить', '➕ Добавить'],
-        ['🗑️ Удалить', '🔙 Назад']
-    ]
-    return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+    return _EDIT_KB
 
 def get_calculate_keyboard():
     """Клавиатура для подсчета"""
-    keyboard = [
-        ['📊 Подробный отчет', '📤 Экспорт в Excel'],
-        ['🔙 Назад']
-    ]
-    return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
\ No newline at end of file
+    return _CALCULATE_KB
\ No newline at end of file
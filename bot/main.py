@@ -1,31 +1,99 @@
-import logging
+import logging.config
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
-    Application, CommandHandler, MessageHandler, CallbackQueryHandler,
-    ConversationHandler, ContextTypes, filters
+    AIORateLimiter, Application, CommandHandler, MessageHandler, CallbackQueryHandler,
+    ConversationHandler, ContextTypes, PicklePersistence, TypeHandler, filters
 )
 from telegram.constants import ParseMode
 import asyncio
-from datetime import datetime, timedelta
-from typing import Dict, Any
+import hashlib
+import time
+from datetime import datetime
+from typing import Dict, Any, Final, List
 
-from config.settings import BOT_TOKEN, ADMIN_IDS, LOGGING_CONFIG
+from config.settings import BOT_TOKEN, ADMIN_IDS, LOGGING_CONFIG, STATE_FILE, SESSION_TTL
 from bot.database.gsheets import get_db
-from bot.services.image_ocr import image_processor
+from bot.services.image_ocr import image_processor, process_batch
 from bot.services.matsuni_calc import calculator
 from bot.services.report_gen import ReportGenerator
 from bot.keyboards.main_menu import (
-    get_main_keyboard, get_post_keyboard, get_yes_no_keyboard,
+    get_main_keyboard, get_post_keyboard,
     get_edit_keyboard, get_calculate_keyboard
 )
 from bot.utils.validators import validate_date, validate_username
-from bot.utils.formatters import format_report, format_member_list
+from bot.utils.formatters import format_report, format_member_list, split_message
 import io
+import zlib
 
 # Настройка логирования
 logging.config.dictConfig(LOGGING_CONFIG)
 logger = logging.getLogger(__name__)
 
+# Фильтры сообщений (создаются один раз при импорте)
+ADD_MEMBER_FILTER = filters.Regex(r'^➕ Добавить участника$')
+NEW_POST_FILTER = filters.Regex(r'^📝 Новый пост$')
+FINISH_STAGE_FILTER = filters.Regex(r'^✅ Завершить этап$')
+CALCULATE_FILTER = filters.Regex(r'^🧮 Подсчитать итог$')
+EXCLUSION_FILTER = filters.Regex(r'^⚠️ Добавить исключение$')
+LIST_MEMBERS_FILTER = filters.Regex(r'^📋 Список участников$')
+EXPORT_EXCEL_FILTER = filters.Regex(r'^📤 Экспорт в Excel$')
+TEXT_INPUT_FILTER = filters.TEXT & ~filters.COMMAND
+
+# Временные данные каждого диалога (удаляются по истечении SESSION_TTL)
+_MEMBER_KEYS = ('new_member',)
+_POST_KEYS = ('post_session', 'post_results')
+_CALC_KEYS = ('calc_start',)
+_EXCLUSION_KEYS = ('exclusion_user', 'exclusion_post')
+_SESSION_KEYS = _MEMBER_KEYS + _POST_KEYS + _CALC_KEYS + _EXCLUSION_KEYS
+
+# Временные данные, которые очищаются при отмене
+_CANCEL_KEYS = _SESSION_KEYS + ('last_calculation',)
+
+# Тексты без динамических данных
+_START_TEXT: Final = (
+    "👋 *Добро пожаловать в бот для подсчета матсуни!*\n\n"
+    "*Основные функции:*\n"
+    "• 📝 Добавление/управление участниками\n"
+    "• 📊 Обработка постов со скриншотами\n"
+    "• 🧮 Автоматический подсчет матсуни\n"
+    "• ⚠️ Исключения для конкретных постов\n"
+    "• 📈 Детальные отчеты и аналитика\n\n"
+    "Выберите действие в меню ниже:"
+)
+_ADD_MEMBER_PROMPT: Final = (
+    "👤 *Добавление участника*\n\n"
+    "Введите username (без @):\n"
+    "Пример: `username123`"
+)
+_NEW_POST_PROMPT: Final = (
+    "📝 *Обработка нового поста*\n\n"
+    "Введите название поста:\n"
+    "Пример: `vibro`, `art_day`, `фото_конкурс`"
+)
+_CALCULATE_PROMPT: Final = (
+    "🧮 *Подсчет итогов*\n\n"
+    "Введите начальную дату периода (ГГГГ-ММ-ДД):\n"
+    "Пример: `2024-01-01`"
+)
+_EXCLUSION_PROMPT: Final = (
+    "⚠️ *Добавление исключения*\n\n"
+    "Введите username участника для исключения:"
+)
+_RECOGNITION_ERROR_TEXT: Final = (
+    "❌ *Ошибка при распознавании скриншотов!*\n"
+    "Скриншоты остались в очереди, нажмите *Завершить этап* еще раз."
+)
+_OCR_RETRY_TEXT: Final = (
+    "⚠️ *Не удалось распознать скриншотов: {count}*\n"
+    "Они остались в очереди: нажмите *Завершить этап*, чтобы повторить.\n"
+    "Скриншоты, не распознанные повторно, будут пропущены."
+)
+_INVALID_DATE_TEXT: Final = (
+    "❌ *Некорректная дата!*\n"
+    "Используйте формат ГГГГ-ММ-ДД\n"
+    "Попробуйте еще раз:"
+)
+
 # Состояния диалога
 class States:
     ADD_MEMBER = 1
@@ -52,7 +120,92 @@ class MatsuniBot:
     def __init__(self):
         self.db = get_db()
         self.report_gen = ReportGenerator()
-        self.user_sessions: Dict[int, Dict] = {}
+        # Обработчики inline кнопок по callback_data
+        self._callbacks = {
+            'save_post': self._on_save_post,
+            'edit_post': self._on_edit_post,
+            'cancel_post': self._on_cancel_post,
+        }
+    
+    async def _download_photos(self, context: ContextTypes.DEFAULT_TYPE, file_ids: List[str]) -> List[bytearray]:
+        """Скачать фото параллельно"""
+        files = await asyncio.gather(*(context.bot.get_file(file_id) for file_id in file_ids))
+        return await asyncio.gather(*(file.download_as_bytearray() for file in files))
+    
+    async def _recognize_pending(self, context: ContextTypes.DEFAULT_TYPE, stage: str) -> Dict[str, Any]:
+        """Скачать и распознать скриншоты этапа в пуле процессов"""
+        session = context.user_data['post_session']
+        pending = session.setdefault(f'pending_{stage}', [])
+        file_ids = list(pending)
+        
+        # OCR читает bytearray напрямую, без копирования в bytes;
+        # сами скриншоты в сессии не хранятся
+        images = []
+        image_keys = []
+        file_keys = []
+        queued = set()
+        seen = session.setdefault('seen_hashes', set())
+        for image_bytes in await self._download_photos(context, file_ids):
+            # Повторно присланный на этом этапе скриншот не распознается заново
+            key = (stage, hashlib.blake2b(image_bytes, digest_size=8).digest())
+            file_keys.append(key)
+            if key not in seen and key not in queued:
+                queued.add(key)
+                image_keys.append(key)
+                images.append(image_bytes)
+        
+        result = {'likes': set(), 'comments': set(), 'errors': [], 'failed': 0, 'skipped': 0}
+        failed = set()
+        if images:
+            # OCR выполняется в пуле процессов, пачки распознаются параллельно
+            loop = asyncio.get_running_loop()
+            chunks = image_processor.split_batches(images)
+            batches = await asyncio.gather(*(
+                loop.run_in_executor(
+                    image_processor.executor, process_batch, chunk, session['members_to_check']
+                )
+                for chunk in chunks
+            ))
+            
+            offset = 0
+            for chunk, batch in zip(chunks, batches):
+                result['likes'].update(batch['likes'])
+                result['comments'].update(batch['comments'])
+                result['errors'].extend(batch['errors'])
+                failed.update(image_keys[offset + i] for i in batch['failed'])
+                offset += len(chunk)
+        
+        # Нераспознанные скриншоты остаются в очереди для повторной попытки;
+        # не распознанные повторно пропускаются, чтобы этап можно было завершить
+        failed_before = session.setdefault('failed_hashes', set())
+        skipped = failed & failed_before
+        failed_before |= failed
+        retry = failed - skipped
+        
+        # В seen попадают только распознанные скриншоты: пропущенный можно прислать заново
+        seen.update(key for key in image_keys if key not in failed)
+        pending[:] = [
+            file_id for file_id, key in zip(file_ids, file_keys) if key in retry
+        ] + pending[len(file_ids):]
+        
+        result['failed'] = len(retry)
+        result['skipped'] = len(skipped)
+        return result
+    
+    async def _report_ocr_failures(self, update: Update, result: Dict[str, Any]) -> bool:
+        """Сообщить о нераспознанных скриншотах; True - этап нужно повторить"""
+        if result['failed']:
+            await update.message.reply_text(
+                _OCR_RETRY_TEXT.format(count=result['failed']),
+                parse_mode=ParseMode.MARKDOWN
+            )
+            return True
+        if result['skipped']:
+            await update.message.reply_text(
+                f"⚠️ Пропущено нераспознанных скриншотов: *{result['skipped']}*",
+                parse_mode=ParseMode.MARKDOWN
+            )
+        return False
     
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Команда /start"""
@@ -63,14 +216,7 @@ class MatsuniBot:
             return
         
         await update.message.reply_text(
-            "👋 *Добро пожаловать в бот для подсчета матсуни!*\n\n"
-            "*Основные функции:*\n"
-            "• 📝 Добавление/управление участниками\n"
-            "• 📊 Обработка постов со скриншотами\n"
-            "• 🧮 Автоматический подсчет матсуни\n"
-            "• ⚠️ Исключения для конкретных постов\n"
-            "• 📈 Детальные отчеты и аналитика\n\n"
-            "Выберите действие в меню ниже:",
+            _START_TEXT,
             parse_mode=ParseMode.MARKDOWN,
             reply_markup=get_main_keyboard()
         )
@@ -78,9 +224,7 @@ class MatsuniBot:
     async def add_member_start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Начать добавление участника"""
         await update.message.reply_text(
-            "👤 *Добавление участника*\n\n"
-            "Введите username (без @):\n"
-            "Пример: `username123`",
+            _ADD_MEMBER_PROMPT,
             parse_mode=ParseMode.MARKDOWN,
             reply_markup=None
         )
@@ -120,9 +264,7 @@ class MatsuniBot:
             
             if not validate_date(join_date):
                 await update.message.reply_text(
-                    "❌ *Некорректная дата!*\n"
-                    "Используйте формат ГГГГ-ММ-ДД\n"
-                    "Попробуйте еще раз:",
+                    _INVALID_DATE_TEXT,
                     parse_mode=ParseMode.MARKDOWN
                 )
                 return States.ADD_MEMBER_DATE
@@ -132,13 +274,13 @@ class MatsuniBot:
         
         try:
             # Добавляем в базу
-            self.db.add_member(username, join_date)
+            await asyncio.to_thread(self.db.add_member, username, join_date)
             
             await update.message.reply_text(
                 f"✅ *Участник добавлен!*\n\n"
                 f"• 👤 Username: `{username}`\n"
                 f"• 📅 Дата добавления: `{join_date}`\n"
-                f"• 🆔 ID в базе: `{hash(username) % 10000:04d}`\n\n"
+                f"• 🆔 ID в базе: `{zlib.crc32(username.encode()) % 10000:04d}`\n\n"
                 "Участник теперь будет учитываться в подсчетах.",
                 parse_mode=ParseMode.MARKDOWN,
                 reply_markup=get_main_keyboard()
@@ -161,7 +303,7 @@ class MatsuniBot:
     async def list_members(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Список всех участников"""
         try:
-            members = self.db.get_members()
+            members = await asyncio.to_thread(self.db.get_members)
             
             if not members:
                 await update.message.reply_text("📭 Список участников пуст.")
@@ -186,16 +328,15 @@ class MatsuniBot:
         """Начать обработку нового поста"""
         # Сбрасываем сессию
         context.user_data['post_session'] = {
-            'images_likes': [],
-            'images_comments': [],
+            'pending_likes': [],
+            'pending_comments': [],
+            'seen_hashes': set(),
             'found_likes': set(),
             'found_comments': set()
         }
         
         await update.message.reply_text(
-            "📝 *Обработка нового поста*\n\n"
-            "Введите название поста:\n"
-            "Пример: `vibro`, `art_day`, `фото_конкурс`",
+            _NEW_POST_PROMPT,
             parse_mode=ParseMode.MARKDOWN,
             reply_markup=None
         )
@@ -207,17 +348,19 @@ class MatsuniBot:
         context.user_data['post_session']['name'] = post_name
         
         # Проверяем исключения для этого поста
-        exclusions = self.db.get_exclusions(post_name)
+        msg = ''
+        exclusions = await asyncio.to_thread(self.db.get_exclusions, post_name)
         if exclusions:
             excluded_users = ', '.join([f"@{ex['username']}" for ex in exclusions])
-            await update.message.reply_text(
+            msg = (
                 f"⚠️ *Внимание!* Для поста `{post_name}` есть исключения:\n"
                 f"{excluded_users}\n\n"
-                "Эти участники не будут учитываться при проверке.",
-                parse_mode=ParseMode.MARKDOWN
+                "Эти участники не будут учитываться при проверке.\n\n"
             )
         
+        # Предупреждение и запрос даты одним сообщением
         await update.message.reply_text(
+            msg +
             f"✅ Название поста: `{post_name}`\n\n"
             "Введите дату поста (ГГГГ-ММ-ДД):\n"
             f"*Текущая дата:* `{datetime.now().strftime('%Y-%m-%d')}`",
@@ -231,18 +374,16 @@ class MatsuniBot:
         
         if not validate_date(date_str):
             await update.message.reply_text(
-                "❌ *Некорректная дата!*\n"
-                "Используйте формат ГГГГ-ММ-ДД\n"
-                "Попробуйте еще раз:",
+                _INVALID_DATE_TEXT,
                 parse_mode=ParseMode.MARKDOWN
             )
             return States.POST_DATE
         
         context.user_data['post_session']['date'] = date_str
         
-        # Получаем участников, добавленных до этой даты
-        members = [m['username'] for m in self.db.get_members()]
-        members_before = self.db.get_members_before_date(date_str)
+        # Получаем участников, добавленных до этой даты (обращения к таблице
+        # могут ждать ограничителя частоты, поэтому выполняются в потоке)
+        members_before = await asyncio.to_thread(self.db.get_members_before_date, date_str)
         
         if not members_before:
             await update.message.reply_text(
@@ -252,7 +393,8 @@ class MatsuniBot:
             )
             return ConversationHandler.END
         
-        context.user_data['post_session']['members_to_check'] = members_before
+        # Множество строится один раз и используется и OCR, и подтверждением
+        context.user_data['post_session']['members_to_check'] = frozenset(members_before)
         
         await update.message.reply_text(
             f"✅ *Параметры поста:*\n\n"
@@ -269,9 +411,27 @@ class MatsuniBot:
     
     async def process_likes_images(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработка скриншотов с лайками"""
+        session = context.user_data['post_session']
+        
         if update.message.text == '✅ Завершить этап':
+            # Распознаем все скриншоты этапа за один вызов
+            try:
+                result = await self._recognize_pending(context, 'likes')
+            except Exception as e:
+                logger.error(f"Error recognizing likes: {e}")
+                await update.message.reply_text(
+                    _RECOGNITION_ERROR_TEXT,
+                    parse_mode=ParseMode.MARKDOWN
+                )
+                return States.POST_LIKES
+            
+            session['found_likes'].update(result['likes'])
+            if await self._report_ocr_failures(update, result):
+                return States.POST_LIKES
+            
             await update.message.reply_text(
-                "✅ *Этап с лайками завершен!*\n\n"
+                "✅ *Этап с лайками завершен!*\n"
+                f"Найдено лайков: *{len(session['found_likes'])}*\n\n"
                 "Теперь отправьте *скриншоты с комментариями*.\n"
                 "Если комментариев нет, нажмите *Завершить этап*",
                 parse_mode=ParseMode.MARKDOWN,
@@ -280,23 +440,12 @@ class MatsuniBot:
             return States.POST_COMMENTS
         
         if update.message.photo:
-            photo = update.message.photo[-1]
-            file = await photo.get_file()
-            image_bytes = await file.download_as_bytearray()
-            
-            # Сохраняем изображение
-            context.user_data['post_session']['images_likes'].append(bytes(image_bytes))
-            
-            # Обрабатываем в фоне
-            members = context.user_data['post_session']['members_to_check']
-            result = image_processor._process_single_image(bytes(image_bytes), members)
-            
-            # Добавляем найденных
-            context.user_data['post_session']['found_likes'].update(result['likes'])
+            # Скачивание и распознавание откладываются до завершения этапа
+            session['pending_likes'].append(update.message.photo[-1].file_id)
             
             await update.message.reply_text(
-                f"✅ Скриншот обработан.\n"
-                f"Найдено лайков: *{len(context.user_data['post_session']['found_likes'])}*",
+                f"📥 Скриншот добавлен в очередь.\n"
+                f"Скриншотов с лайками: *{len(session['pending_likes'])}*",
                 parse_mode=ParseMode.MARKDOWN
             )
         
@@ -304,28 +453,34 @@ class MatsuniBot:
     
     async def process_comments_images(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработка скриншотов с комментариями"""
+        session = context.user_data['post_session']
+        
         if update.message.text == '✅ Завершить этап':
+            # Распознаем все скриншоты этапа за один вызов
+            try:
+                result = await self._recognize_pending(context, 'comments')
+            except Exception as e:
+                logger.error(f"Error recognizing comments: {e}")
+                await update.message.reply_text(
+                    _RECOGNITION_ERROR_TEXT,
+                    parse_mode=ParseMode.MARKDOWN
+                )
+                return States.POST_COMMENTS
+            
+            session['found_comments'].update(result['comments'])
+            if await self._report_ocr_failures(update, result):
+                return States.POST_COMMENTS
+            
             # Переходим к подтверждению
             return await self.confirm_post(update, context)
         
         if update.message.photo:
-            photo = update.message.photo[-1]
-            file = await photo.get_file()
-            image_bytes = await file.download_as_bytearray()
-            
-            # Сохраняем изображение
-            context.user_data['post_session']['images_comments'].append(bytes(image_bytes))
-            
-            # Обрабатываем в фоне
-            members = context.user_data['post_session']['members_to_check']
-            result = image_processor._process_single_image(bytes(image_bytes), members)
-            
-            # Добавляем найденных
-            context.user_data['post_session']['found_comments'].update(result['comments'])
+            # Скачивание и распознавание откладываются до завершения этапа
+            session['pending_comments'].append(update.message.photo[-1].file_id)
             
             await update.message.reply_text(
-                f"✅ Скриншот обработан.\n"
-                f"Найдено комментариев: *{len(context.user_data['post_session']['found_comments'])}*",
+                f"📥 Скриншот добавлен в очередь.\n"
+                f"Скриншотов с комментариями: *{len(session['pending_comments'])}*",
                 parse_mode=ParseMode.MARKDOWN
             )
         
@@ -338,17 +493,23 @@ class MatsuniBot:
         # Создаем ID поста
         post_id = f"{session['name']}_{session['date']}_{datetime.now().strftime('%H%M%S')}"
         
+        # Разбиваем участников на группы операциями над множествами
+        members = session['members_to_check']
+        likes = session['found_likes'] & members
+        comments = session['found_comments'] & members
+        groups = (
+            (likes & comments, True, True),
+            (comments - likes, False, True),
+            (likes - comments, True, False),
+            (members - likes - comments, False, False),
+        )
+        
         # Рассчитываем активность для каждого участника
-        activities = []
-        for member in session['members_to_check']:
-            has_like = member in session['found_likes']
-            has_comment = member in session['found_comments']
-            
-            activities.append({
-                'username': member,
-                'has_like': has_like,
-                'has_comment': has_comment
-            })
+        activities = [
+            {'username': member, 'has_like': has_like, 'has_comment': has_comment}
+            for group, has_like, has_comment in groups
+            for member in sorted(group)
+        ]
         
         # Рассчитываем матсуни
         post_data = {
@@ -357,7 +518,7 @@ class MatsuniBot:
             'date': session['date']
         }
         
-        results = calculator.calculate_for_post(post_data, activities)
+        results = await asyncio.to_thread(calculator.calculate_for_post, post_data, activities)
         
         # Формируем отчет для подтверждения
         total_matsuni = sum(r['matsuni'] for r in results)
@@ -382,7 +543,7 @@ class MatsuniBot:
             report += f"... и еще {len(active_members) - 5} участников\n"
         
         keyboard = [
-            [InlineKeyboardButton("✅ Сохранить", callback_data=f"save_post_{post_id}")],
+            [InlineKeyboardButton("✅ Сохранить", callback_data="save_post")],
             [InlineKeyboardButton("✏️ Редактировать", callback_data="edit_post")],
             [InlineKeyboardButton("❌ Отменить", callback_data="cancel_post")]
         ]
@@ -408,67 +569,73 @@ class MatsuniBot:
         
         data = query.data
         
-        if data.startswith('save_post_'):
-            # Сохраняем пост
-            post_results = context.user_data.get('post_results')
-            if post_results:
-                try:
-                    self.db.save_activity(
-                        post_results['post_data'],
-                        post_results['results']
-                    )
-                    
-                    await query.edit_message_text(
-                        "✅ *Пост успешно сохранен!*\n"
-                        "Данные добавлены в таблицу.",
-                        parse_mode=ParseMode.MARKDOWN
-                    )
-                    
-                    # Очищаем сессию
-                    if 'post_session' in context.user_data:
-                        del context.user_data['post_session']
-                    if 'post_results' in context.user_data:
-                        del context.user_data['post_results']
-                    
-                except Exception as e:
-                    logger.error(f"Error saving post: {e}")
-                    await query.edit_message_text(
-                        "❌ *Ошибка при сохранении!*\n"
-                        "Проверьте логи или попробуйте позже.",
-                        parse_mode=ParseMode.MARKDOWN
-                    )
-        
-        elif data == 'edit_post':
-            # Режим редактирования
-            await query.edit_message_text(
-                "✏️ *Режим редактирования*\n\n"
-                "Выберите действие:",
-                reply_markup=get_edit_keyboard()
-            )
-            return States.EDIT_CHOICE
+        handler = self._callbacks.get(data)
+        if handler is None and data.startswith('save_post_'):
+            # Кнопки, отправленные до перехода на ключ без ID поста
+            handler = self._on_save_post
+        if handler is not None:
+            return await handler(query, context)
         
-        elif data == 'cancel_post':
-            await query.edit_message_text(
-                "❌ *Обработка поста отменена*",
-                reply_markup=get_main_keyboard()
-            )
-            
-            # Очищаем сессию
-            if 'post_session' in context.user_data:
-                del context.user_data['post_session']
-            if 'post_results' in context.user_data:
-                del context.user_data['post_results']
-            
-            return ConversationHandler.END
+        return ConversationHandler.END
+    
+    async def _on_save_post(self, query, context: ContextTypes.DEFAULT_TYPE):
+        """Сохранить пост"""
+        post_results = context.user_data.get('post_results')
+        if post_results:
+            try:
+                # Запись в таблицу не блокирует цикл событий
+                await asyncio.to_thread(
+                    self.db.save_activity,
+                    post_results['post_data'],
+                    post_results['results']
+                )
+                
+                await query.edit_message_text(
+                    "✅ *Пост успешно сохранен!*\n"
+                    "Данные добавлены в таблицу.",
+                    parse_mode=ParseMode.MARKDOWN
+                )
+                
+                # Очищаем сессию
+                for key in _POST_KEYS:
+                    context.user_data.pop(key, None)
+                
+            except Exception as e:
+                logger.error(f"Error saving post: {e}")
+                await query.edit_message_text(
+                    "❌ *Ошибка при сохранении!*\n"
+                    "Проверьте логи или попробуйте позже.",
+                    parse_mode=ParseMode.MARKDOWN
+                )
+        
+        return ConversationHandler.END
+    
+    async def _on_edit_post(self, query, context: ContextTypes.DEFAULT_TYPE):
+        """Режим редактирования"""
+        await query.edit_message_text(
+            "✏️ *Режим редактирования*\n\n"
+            "Выберите действие:",
+            reply_markup=get_edit_keyboard()
+        )
+        return States.EDIT_CHOICE
+    
+    async def _on_cancel_post(self, query, context: ContextTypes.DEFAULT_TYPE):
+        """Отменить обработку поста"""
+        await query.edit_message_text(
+            "❌ *Обработка поста отменена*",
+            reply_markup=get_main_keyboard()
+        )
+        
+        # Очищаем сессию
+        for key in _POST_KEYS:
+            context.user_data.pop(key, None)
         
         return ConversationHandler.END
     
     async def calculate_start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Начать подсчет итогов"""
         await update.message.reply_text(
-            "🧮 *Подсчет итогов*\n\n"
-            "Введите начальную дату периода (ГГГГ-ММ-ДД):\n"
-            "Пример: `2024-01-01`",
+            _CALCULATE_PROMPT,
             parse_mode=ParseMode.MARKDOWN,
             reply_markup=None
         )
@@ -480,9 +647,7 @@ class MatsuniBot:
         
         if not validate_date(start_date):
             await update.message.reply_text(
-                "❌ *Некорректная дата!*\n"
-                "Используйте формат ГГГГ-ММ-ДД\n"
-                "Попробуйте еще раз:",
+                _INVALID_DATE_TEXT,
                 parse_mode=ParseMode.MARKDOWN
             )
             return States.CALCULATE_START
@@ -503,9 +668,7 @@ class MatsuniBot:
         
         if not validate_date(end_date):
             await update.message.reply_text(
-                "❌ *Некорректная дата!*\n"
-                "Используйте формат ГГГГ-ММ-ДД\n"
-                "Попробуйте еще раз:",
+                _INVALID_DATE_TEXT,
                 parse_mode=ParseMode.MARKDOWN
             )
             return States.CALCULATE_END
@@ -527,28 +690,23 @@ class MatsuniBot:
         )
         
         try:
-            # Рассчитываем итоги
-            results = calculator.calculate_period_totals(start_date, end_date)
+            # Подсчет и отчет выполняются в потоке, не блокируя цикл событий
+            results = await asyncio.to_thread(calculator.calculate_period_totals, start_date, end_date)
             
             # Генерируем отчет
-            report = format_report(results)
+            report = await asyncio.to_thread(format_report, results)
             
             # Отправляем отчет
             await loading_msg.delete()
             
-            # Разбиваем на части, если отчет слишком большой
-            if len(report) > 4000:
-                parts = [report[i:i+4000] for i in range(0, len(report), 4000)]
-                for part in parts:
-                    await update.message.reply_text(
-                        part,
-                        parse_mode=ParseMode.MARKDOWN
-                    )
-            else:
+            # Разбиваем по абзацам, чтобы не разрывать разметку;
+            # части отправляются по порядку, клавиатура - к последней
+            parts = split_message(report)
+            for i, part in enumerate(parts, 1):
                 await update.message.reply_text(
-                    report,
+                    part,
                     parse_mode=ParseMode.MARKDOWN,
-                    reply_markup=get_calculate_keyboard()
+                    reply_markup=get_calculate_keyboard() if i == len(parts) else None
                 )
             
             # Сохраняем результаты для возможного экспорта
@@ -587,7 +745,7 @@ class MatsuniBot:
         
         try:
             # Экспортируем данные
-            excel_data = self.db.export_to_excel(last_calc['period'])
+            excel_data = await asyncio.to_thread(self.db.export_to_excel, last_calc['period'])
             
             await loading_msg.delete()
             
@@ -611,8 +769,7 @@ class MatsuniBot:
     async def add_exclusion_start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Добавить исключение"""
         await update.message.reply_text(
-            "⚠️ *Добавление исключения*\n\n"
-            "Введите username участника для исключения:",
+            _EXCLUSION_PROMPT,
             parse_mode=ParseMode.MARKDOWN,
             reply_markup=None
         )
@@ -623,8 +780,7 @@ class MatsuniBot:
         username = update.message.text.strip()
         
         # Проверяем существование участника
-        members = [m['username'] for m in self.db.get_members()]
-        if username not in members:
+        if username not in await asyncio.to_thread(self.db.usernames):
             await update.message.reply_text(
                 f"❌ *Участник @{username} не найден!*\n"
                 "Проверьте правильность username.",
@@ -663,7 +819,7 @@ class MatsuniBot:
         post_name = context.user_data['exclusion_post']
         
         try:
-            self.db.add_exclusion(username, post_name, reason)
+            await asyncio.to_thread(self.db.add_exclusion, username, post_name, reason)
             
             await update.message.reply_text(
                 f"✅ *Исключение добавлено!*\n\n"
@@ -689,6 +845,45 @@ class MatsuniBot:
         
         return ConversationHandler.END
     
+    def session_timeout(self, keys: tuple):
+        """Обработчик таймаута диалога, очищающий только его данные"""
+        async def callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+            for key in keys:
+                context.user_data.pop(key, None)
+            logger.info(f"Conversation timed out for user {update.effective_user.id}")
+        return callback
+    
+    async def track_activity(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Отметка времени последнего обращения пользователя"""
+        if context.user_data is not None:
+            context.user_data['last_activity'] = time.time()
+    
+    async def sweep_sessions(self, context: ContextTypes.DEFAULT_TYPE):
+        """Завершение брошенных диалогов, восстановленных после перезапуска"""
+        # Задачи таймаута ConversationHandler не сохраняются в PicklePersistence:
+        # восстановленный диалог без этой очистки не истекает никогда
+        deadline = time.time() - SESSION_TTL.total_seconds()
+        stale = {
+            user_id for user_id, data in context.application.user_data.items()
+            if data.get('last_activity', 0) < deadline
+        }
+        if not stale:
+            return
+        
+        # Публичного API для завершения диалога нет; ключ диалога - (chat_id, user_id)
+        for conversation in context.job.data:
+            for key in list(conversation._conversations):
+                if key[-1] in stale:
+                    conversation._update_state(ConversationHandler.END, key)
+        
+        for user_id in stale:
+            data = context.application.user_data[user_id]
+            if any(key in data for key in _SESSION_KEYS):
+                for key in _SESSION_KEYS:
+                    data.pop(key, None)
+                context.application.mark_data_for_update_persistence(user_ids=user_id)
+                logger.info(f"Stale session swept for user {user_id}")
+    
     async def cancel(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Отмена текущего действия"""
         await update.message.reply_text(
@@ -697,110 +892,130 @@ class MatsuniBot:
         )
         
         # Очищаем все временные данные
-        keys_to_remove = [
-            'new_member', 'post_session', 'post_results',
-            'calc_start', 'last_calculation',
-            'exclusion_user', 'exclusion_post'
-        ]
-        
-        for key in keys_to_remove:
-            if key in context.user_data:
-                del context.user_data[key]
+        for key in _CANCEL_KEYS:
+            context.user_data.pop(key, None)
         
         return ConversationHandler.END
 
-def main():
-    """Запуск бота"""
+def build_application() -> Application:
+    """Создать приложение бота со всеми обработчиками"""
     # Создаем экземпляр бота
     bot = MatsuniBot()
     
-    # Создаем приложение
-    application = Application.builder().token(BOT_TOKEN).build()
+    # Создаем приложение; исходящие запросы сглаживаются под лимиты Telegram,
+    # а состояние диалогов сохраняется на диск
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .rate_limiter(AIORateLimiter(overall_max_rate=30, overall_time_period=1, max_retries=3))
+        .persistence(PicklePersistence(filepath=STATE_FILE))
+        .build()
+    )
     
+    # Брошенные диалоги завершаются по таймауту с очисткой данных этого диалога
     # Диалог для добавления участника
     add_member_conv = ConversationHandler(
         entry_points=[
-            MessageHandler(filters.Regex('^➕ Добавить участника$'), bot.add_member_start),
+            MessageHandler(ADD_MEMBER_FILTER, bot.add_member_start),
             CommandHandler('add_member', bot.add_member_start)
         ],
         states={
             States.ADD_MEMBER: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, bot.add_member_process)
+                MessageHandler(TEXT_INPUT_FILTER, bot.add_member_process)
             ],
             States.ADD_MEMBER_DATE: [
                 MessageHandler(filters.TEXT, bot.add_member_date),
                 CommandHandler('skip', bot.add_member_date)
-            ]
+            ],
+            ConversationHandler.TIMEOUT: [TypeHandler(Update, bot.session_timeout(_MEMBER_KEYS))]
         },
-        fallbacks=[CommandHandler('cancel', bot.cancel)]
+        fallbacks=[CommandHandler('cancel', bot.cancel)],
+        name='add_member',
+        persistent=True,
+        conversation_timeout=SESSION_TTL
     )
     
     # Диалог для нового поста
     new_post_conv = ConversationHandler(
         entry_points=[
-            MessageHandler(filters.Regex('^📝 Новый пост$'), bot.new_post_start),
+            MessageHandler(NEW_POST_FILTER, bot.new_post_start),
             CommandHandler('new_post', bot.new_post_start)
         ],
         states={
             States.POST_NAME: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, bot.process_post_name)
+                MessageHandler(TEXT_INPUT_FILTER, bot.process_post_name)
             ],
             States.POST_DATE: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, bot.process_post_date)
+                MessageHandler(TEXT_INPUT_FILTER, bot.process_post_date)
             ],
             States.POST_LIKES: [
                 MessageHandler(filters.PHOTO, bot.process_likes_images),
-                MessageHandler(filters.Regex('^✅ Завершить этап$'), bot.process_likes_images)
+                MessageHandler(FINISH_STAGE_FILTER, bot.process_likes_images)
             ],
             States.POST_COMMENTS: [
                 MessageHandler(filters.PHOTO, bot.process_comments_images),
-                MessageHandler(filters.Regex('^✅ Завершить этап$'), bot.process_comments_images)
+                MessageHandler(FINISH_STAGE_FILTER, bot.process_comments_images)
             ],
             States.POST_CONFIRM: [
                 CallbackQueryHandler(bot.button_callback)
-            ]
+            ],
+            ConversationHandler.TIMEOUT: [TypeHandler(Update, bot.session_timeout(_POST_KEYS))]
         },
-        fallbacks=[CommandHandler('cancel', bot.cancel)]
+        fallbacks=[CommandHandler('cancel', bot.cancel)],
+        name='new_post',
+        persistent=True,
+        conversation_timeout=SESSION_TTL
     )
     
     # Диалог для подсчета итогов
     calculate_conv = ConversationHandler(
         entry_points=[
-            MessageHandler(filters.Regex('^🧮 Подсчитать итог$'), bot.calculate_start),
+            MessageHandler(CALCULATE_FILTER, bot.calculate_start),
             CommandHandler('calculate', bot.calculate_start)
         ],
         states={
             States.CALCULATE_START: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, bot.calculate_process_start)
+                MessageHandler(TEXT_INPUT_FILTER, bot.calculate_process_start)
             ],
             States.CALCULATE_END: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, bot.calculate_process_end)
-            ]
+                MessageHandler(TEXT_INPUT_FILTER, bot.calculate_process_end)
+            ],
+            ConversationHandler.TIMEOUT: [TypeHandler(Update, bot.session_timeout(_CALC_KEYS))]
         },
-        fallbacks=[CommandHandler('cancel', bot.cancel)]
+        fallbacks=[CommandHandler('cancel', bot.cancel)],
+        name='calculate',
+        persistent=True,
+        conversation_timeout=SESSION_TTL
     )
     
     # Диалог для добавления исключений
     exclusion_conv = ConversationHandler(
         entry_points=[
-            MessageHandler(filters.Regex('^⚠️ Добавить исключение$'), bot.add_exclusion_start),
+            MessageHandler(EXCLUSION_FILTER, bot.add_exclusion_start),
             CommandHandler('exclude', bot.add_exclusion_start)
         ],
         states={
             States.EXCLUSION_ADD: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, bot.process_exclusion_username)
+                MessageHandler(TEXT_INPUT_FILTER, bot.process_exclusion_username)
             ],
             States.EXCLUSION_POST: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, bot.process_exclusion_post)
+                MessageHandler(TEXT_INPUT_FILTER, bot.process_exclusion_post)
             ],
             States.EXCLUSION_REASON: [
                 MessageHandler(filters.TEXT, bot.process_exclusion_reason),
                 CommandHandler('skip', bot.process_exclusion_reason)
-            ]
+            ],
+            ConversationHandler.TIMEOUT: [TypeHandler(Update, bot.session_timeout(_EXCLUSION_KEYS))]
         },
-        fallbacks=[CommandHandler('cancel', bot.cancel)]
+        fallbacks=[CommandHandler('cancel', bot.cancel)],
+        name='exclusion',
+        persistent=True,
+        conversation_timeout=SESSION_TTL
     )
     
+    # Время последнего обращения нужно для очистки восстановленных диалогов
+    application.add_handler(TypeHandler(Update, bot.track_activity), group=-1)
+    
     # Основные обработчики
     application.add_handler(CommandHandler("start", bot.start))
     application.add_handler(add_member_conv)
@@ -810,12 +1025,26 @@ def main():
     
     # Дополнительные обработчики
     application.add_handler(MessageHandler(
-        filters.Regex('^📋 Список участников$'), bot.list_members
+        LIST_MEMBERS_FILTER, bot.list_members
     ))
     application.add_handler(MessageHandler(
-        filters.Regex('^📤 Экспорт в Excel$'), bot.export_excel
+        EXPORT_EXCEL_FILTER, bot.export_excel
     ))
     
+    # Периодически завершаем диалоги, чьи таймауты потерялись при перезапуске
+    application.job_queue.run_repeating(
+        bot.sweep_sessions,
+        interval=SESSION_TTL / 4,
+        first=0,
+        data=[add_member_conv, new_post_conv, calculate_conv, exclusion_conv]
+    )
+    
+    return application
+
+def main():
+    """Запуск бота"""
+    application = build_application()
+    
     # Запускаем бота
     logger.info("Бот запускается...")
     application.run_polling(allowed_updates=Update.ALL_TYPES)
@@ -1,178 +1,229 @@
 import pytesseract
-from PIL import Image, ImageEnhance, ImageFilter
+import hashlib
 import io
 import re
 import cv2
 import numpy as np
-from typing import List, Tuple, Dict
+from typing import Any, Collection, List, Optional, Tuple, Dict
 import logging
-from concurrent.futures import ThreadPoolExecutor
+import multiprocessing
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 import cachetools
+from rapidfuzz import fuzz, process
+from rapidfuzz.distance import Levenshtein
+from PIL import Image
 
 logger = logging.getLogger(__name__)
 
+# Паттерн поиска имен пользователей: @username, username:, "username любит/нравится".
+# Без групп захвата findall сразу возвращает список строк
+_USERNAME_PATTERN = re.compile(
+    r'(?<=@)[a-z0-9_.]+|[a-z0-9_.]+(?=\s*(?::|любит|нравится))',
+    re.IGNORECASE
+)
+
+# Исправления типичных ошибок OCR. Цифры не заменяются:
+# они разрешены whitelist'ом и встречаются в именах пользователей
+_OCR_CORRECTIONS = {
+    '@5': '@s',
+    'vv': 'w',
+    'rn': 'm',
+}
+_OCR_FIX_PATTERN = re.compile('|'.join(map(re.escape, _OCR_CORRECTIONS)))
+
+# Конфигурация Tesseract для соцсетей
+_TESS_CONFIG = r'--oem 3 --psm 6 -c tessedit_char_whitelist=abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789@._-: '
+
+# Признаки скриншота комментариев. Ищутся как подстроки: "comments", "ответила" и т.п.
+_COMMENT_MARKERS = ('комментарий', 'comment', 'ответил', 'ответила')
+_COMMENT_PATTERN = re.compile('|'.join(map(re.escape, _COMMENT_MARKERS)))
+
+# Максимальная ширина изображения перед OCR
+MAX_IMAGE_WIDTH = 1600
+
 class ImageProcessor:
     """Улучшенный процессор изображений с кэшированием"""
     
     def __init__(self):
-        self.executor = ThreadPoolExecutor(max_workers=4)
+        self._executor = None
+        self._clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
         self.cache = cachetools.TTLCache(maxsize=100, ttl=3600)  # 1 час
+    
+    @property
+    def executor(self) -> ProcessPoolExecutor:
+        """Пул процессов для OCR (создается при первом обращении)"""
+        # Пул, в котором умер воркер, навсегда остается BrokenProcessPool - пересоздаем его
+        if self._executor is not None and self._executor._broken:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+        if self._executor is None:
+            # forkserver вместо fork: к первому OCR в процессе уже работают потоки
+            # (to_thread, таймер записи, Flask), и форк с чужой захваченной
+            # блокировкой может повесить воркер
+            self._executor = ProcessPoolExecutor(
+                max_workers=os.cpu_count(),
+                mp_context=multiprocessing.get_context('forkserver')
+            )
+        return self._executor
         
-    def preprocess_image(self, image_bytes: bytes) -> Image.Image:
+    def preprocess_image(self, image_bytes: bytes) -> np.ndarray:
         """Предобработка изображения для лучшего распознавания"""
-        # Конвертируем в OpenCV формат
+        # Декодируем сразу в grayscale, без промежуточного цветного буфера
         nparr = np.frombuffer(image_bytes, np.uint8)
-        img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+        gray = cv2.imdecode(nparr, cv2.IMREAD_GRAYSCALE)
+        
+        # Уменьшаем слишком широкие скриншоты до всех остальных операций
+        height, width = gray.shape
+        if width > MAX_IMAGE_WIDTH:
+            size = (MAX_IMAGE_WIDTH, round(height * MAX_IMAGE_WIDTH / width))
+            gray = cv2.resize(gray, size, interpolation=cv2.INTER_AREA)
         
-        # Конвертируем в grayscale
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        # Увеличиваем контраст до бинаризации (на двухцветном изображении CLAHE бесполезен)
+        gray = self._clahe.apply(gray)
         
-        # Применяем адаптивный threshold
+        # Применяем адаптивный threshold поверх того же буфера
         thresh = cv2.adaptiveThreshold(
             gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, 
-            cv2.THRESH_BINARY, 11, 2
+            cv2.THRESH_BINARY, 11, 2, dst=gray
         )
         
         # Убираем шум
-        kernel = np.ones((1, 1), np.uint8)
-        thresh = cv2.morphologyEx(thresh, cv2.MORPH_CLOSE, kernel)
-        thresh = cv2.morphologyEx(thresh, cv2.MORPH_OPEN, kernel)
-        
-        # Увеличиваем контраст
-        clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
-        thresh = clahe.apply(thresh)
-        
-        # Конвертируем обратно в PIL
-        result = Image.fromarray(thresh)
-        
-        # Улучшаем резкость
-        enhancer = ImageEnhance.Sharpness(result)
-        result = enhancer.enhance(2.0)
+        thresh = cv2.medianBlur(thresh, 3)
         
-        return result
+        # pytesseract принимает массив NumPy напрямую, без конвертации в PIL
+        return thresh
     
-    @cachetools.cached(lambda self, image_bytes: cachetools.keys.hashkey(image_bytes), 
-                      cache=lambda self: self.cache)
     def extract_text(self, image_bytes: bytes, lang: str = 'eng+rus') -> str:
         """Извлечь текст из изображения с кэшированием"""
+        key = self._cache_key(image_bytes, lang)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached
+        
         try:
             # Предобработка
             processed_image = self.preprocess_image(image_bytes)
             
-            # Конфигурация для соцсетей
-            custom_config = r'--oem 3 --psm 6 -c tessedit_char_whitelist=abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789@._-: '
-            
             # Извлекаем текст
             text = pytesseract.image_to_string(
                 processed_image,
                 lang=lang,
-                config=custom_config
+                config=_TESS_CONFIG
             )
             
             # Очищаем текст
-            text = self._clean_text(text)
+            text = self._clean_text(text).lower()
             
             logger.debug(f"Extracted text length: {len(text)}")
-            return text.lower()
+            self.cache[key] = text
+            return text
             
         except Exception as e:
+            # Ошибка пробрасывается: пустой текст неотличим от скриншота без имен
             logger.error(f"Error extracting text: {e}")
-            return ""
+            raise
+    
+    def extract_texts(self, images: List[bytes], lang: str = 'eng+rus') -> List[Optional[str]]:
+        """Извлечь текст из пачки изображений одним запуском Tesseract (None - ошибка OCR)"""
+        keys = [self._cache_key(image_bytes, lang) for image_bytes in images]
+        texts = [self.cache.get(key) for key in keys]
+        missing = [i for i, text in enumerate(texts) if text is None]
+        
+        # Несколько изображений склеиваются в многостраничный TIFF:
+        # процесс tesseract и языковые модели загружаются один раз на пачку
+        if len(missing) > 1:
+            try:
+                pages = [Image.fromarray(self.preprocess_image(images[i])) for i in missing]
+                with tempfile.TemporaryDirectory() as tmp_dir:
+                    path = os.path.join(tmp_dir, 'batch.tif')
+                    pages[0].save(path, save_all=True, append_images=pages[1:])
+                    output = pytesseract.image_to_string(path, lang=lang, config=_TESS_CONFIG)
+                
+                # Tesseract завершает каждую страницу символом '\f'
+                page_texts = output.split('\f')
+                if len(page_texts) < len(missing):
+                    raise ValueError(f"Expected {len(missing)} pages, got {len(page_texts)}")
+                
+                for i, page_text in zip(missing, page_texts):
+                    texts[i] = self._clean_text(page_text).lower()
+                    self.cache[keys[i]] = texts[i]
+                missing = []
+            except Exception as e:
+                logger.error(f"Error extracting batch text, falling back to single images: {e}")
+        
+        for i in missing:
+            try:
+                texts[i] = self.extract_text(images[i], lang)
+            except Exception:
+                texts[i] = None
+        
+        return texts
+    
+    def _cache_key(self, image_bytes: bytes, lang: str) -> Tuple[bytes, str]:
+        """Ключ кэша OCR"""
+        # Ключ - хеш содержимого, а не сами байты скриншота
+        return (hashlib.blake2b(image_bytes, digest_size=16).digest(), lang)
     
     def _clean_text(self, text: str) -> str:
         """Очистка текста"""
         # Убираем лишние пробелы
         text = ' '.join(text.split())
         
-        # Исправляем common OCR ошибки
-        corrections = {
-            '@5': '@s',
-            '1': 'l',
-            '0': 'o',
-            'vv': 'w',
-            'rn': 'm',
-        }
-        
-        for wrong, correct in corrections.items():
-            text = text.replace(wrong, correct)
-        
-        return text
+        # Исправляем common OCR ошибки за один проход
+        return _OCR_FIX_PATTERN.sub(lambda m: _OCR_CORRECTIONS[m.group(0)], text)
     
-    def find_usernames(self, text: str, members_list: List[str], 
+    def find_usernames(self, text: str, members_list: Collection[str], 
                       min_confidence: float = 0.8) -> List[Tuple[str, float]]:
         """Найти имена пользователей с уверенностью"""
-        found = []
-        
-        # Создаем паттерны для поиска
-        patterns = [
-            r'@([a-zA-Z0-9_.]+)',  # @username
-            r'([a-zA-Z0-9_.]+)\s*:',  # username:
-            r'([a-zA-Z0-9_.]+)\s*любит',  # для Instagram
-            r'([a-zA-Z0-9_.]+)\s*нравится',
-        ]
-        
-        all_patterns = '|'.join(patterns)
-        matches = re.findall(all_patterns, text, re.IGNORECASE)
-        
-        # Обрабатываем найденные совпадения
-        for match in matches:
-            # re.findall возвращает кортежи для групп, выбираем непустые
-            username = match if isinstance(match, str) else ''.join(match)
-            
-            # Проверяем каждого участника
-            for member in members_list:
-                confidence = self._calculate_similarity(username.lower(), member.lower())
-                if confidence >= min_confidence:
-                    found.append((member, confidence))
-        
-        # Убираем дубликаты, оставляя максимальную уверенность
-        unique_found = {}
-        for username, confidence in found:
-            if username not in unique_found or confidence > unique_found[username]:
-                unique_found[username] = confidence
+        matches = _USERNAME_PATTERN.findall(text)
+        
+        candidates = list(dict.fromkeys(match.lower() for match in matches))
+        members = list(members_list)
+        if not candidates or not members:
+            return []
+        members_lower = [member.lower() for member in members]
+        
+        # Точные совпадения находятся поиском в словаре, без нечеткого сравнения
+        exact = dict(zip(members_lower, members))
+        found = {exact[c]: 1.0 for c in candidates if c in exact}
+        candidates = [c for c in candidates if c not in exact]
+        
+        # Нечетко сравниваются только оставшиеся кандидаты с ненайденными участниками
+        rest = [(m, ml) for m, ml in zip(members, members_lower) if m not in found]
+        if not candidates or not rest:
+            return sorted(found.items(), key=lambda x: x[1], reverse=True)
+        members, members_lower = map(list, zip(*rest))
+        
+        # Матрица схожести кандидат x участник считается целиком в C.
+        # score_cutoff не передается: rapidfuzz применяет его к расстоянию
+        # и отбрасывает пары ровно на пороге, а сравнение ниже нестрогое
+        scores = process.cdist(
+            candidates, members_lower, scorer=Levenshtein.normalized_similarity
+        )
+        
+        # Кандидат, входящий в имя участника (или наоборот), получает 0.9
+        substrings = process.cdist(
+            candidates, members_lower, scorer=fuzz.partial_ratio, score_cutoff=100
+        )
+        scores = np.where((substrings >= 100) & (scores < 1.0), 0.9, scores)
+        
+        # Для каждого участника берем максимальную уверенность
+        best = scores.max(axis=0)
+        for j in np.flatnonzero(best >= min_confidence):
+            found.setdefault(members[j], float(best[j]))
         
         # Сортируем по уверенности
-        return sorted(unique_found.items(), key=lambda x: x[1], reverse=True)
+        return sorted(found.items(), key=lambda x: x[1], reverse=True)
     
-    def _calculate_similarity(self, str1: str, str2: str) -> float:
-        """Вычислить схожесть строк (расстояние Левенштейна)"""
-        if str1 == str2:
-            return 1.0
-        
-        # Простой алгоритм схожести
-        longer = str1 if len(str1) > len(str2) else str2
-        shorter = str1 if len(str1) <= len(str2) else str2
-        
-        # Проверка на подстроку
-        if shorter in longer:
-            return 0.9
-        
-        # Вычисляем расстояние Левенштейна
-        matrix = [[0] * (len(str2) + 1) for _ in range(len(str1) + 1)]
-        
-        for i in range(len(str1) + 1):
-            matrix[i][0] = i
-        for j in range(len(str2) + 1):
-            matrix[0][j] = j
-        
-        for i in range(1, len(str1) + 1):
-            for j in range(1, len(str2) + 1):
-                cost = 0 if str1[i-1] == str2[j-1] else 1
-                matrix[i][j] = min(
-                    matrix[i-1][j] + 1,      # удаление
-                    matrix[i][j-1] + 1,      # вставка
-                    matrix[i-1][j-1] + cost  # замена
-                )
-        
-        distance = matrix[len(str1)][len(str2)]
-        max_len = max(len(str1), len(str2))
-        
-        if max_len == 0:
-            return 1.0
-        
-        return 1.0 - (distance / max_len)
+    def split_batches(self, images: List[bytes]) -> List[List[bytes]]:
+        """Разбить изображения на пачки по числу процессов пула"""
+        # По одной пачке на процесс, чтобы не платить за IPC на каждом изображении
+        size = max(1, -(-len(images) // (os.cpu_count() or 1)))
+        return [images[i:i + size] for i in range(0, len(images), size)]
     
-    def batch_process_images(self, images: List[bytes], members_list: List[str]) -> Dict[str, List]:
+    def batch_process_images(self, images: List[bytes], members_list: Collection[str]) -> Dict[str, List]:
         """Пакетная обработка изображений"""
         results = {
             'likes': set(),
@@ -181,32 +232,31 @@ class ImageProcessor:
         }
         
         futures = []
-        for image_bytes in images:
-            future = self.executor.submit(
-                self._process_single_image,
-                image_bytes,
-                members_list
-            )
-            futures.append(future)
+        for chunk in self.split_batches(images):
+            future = self.executor.submit(process_batch, chunk, members_list)
+            futures.append((future, len(chunk)))
         
         # Собираем результаты
-        for future in futures:
+        for future, count in futures:
             try:
-                result = future.result(timeout=30)
+                result = future.result(timeout=30 * count)
                 results['likes'].update(result['likes'])
                 results['comments'].update(result['comments'])
+                results['errors'].extend(result['errors'])
             except Exception as e:
                 results['errors'].append(str(e))
                 logger.error(f"Error in batch processing: {e}")
         
         return results
     
-    def _process_single_image(self, image_bytes: bytes, members_list: List[str]) -> Dict:
+    def _process_single_image(self, image_bytes: bytes, members_list: Collection[str]) -> Dict:
         """Обработать одно изображение"""
-        text = self.extract_text(image_bytes)
-        
+        return self._process_text(self.extract_text(image_bytes), members_list)
+    
+    def _process_text(self, text: str, members_list: Collection[str]) -> Dict:
+        """Разобрать распознанный текст скриншота"""
         # Определяем тип (лайки или комментарии)
-        is_comments = any(word in text for word in ['комментарий', 'comment', 'ответил', 'ответила'])
+        is_comments = _COMMENT_PATTERN.search(text) is not None
         
         found_usernames = self.find_usernames(text, members_list)
         
@@ -217,4 +267,32 @@ class ImageProcessor:
         }
 
 # Глобальный экземпляр процессора
-image_processor = ImageProcessor()
\ No newline at end of file
+image_processor = ImageProcessor()
+
+def process_batch(images: List[bytes], members_list: Collection[str]) -> Dict[str, Any]:
+    """Распознать пакет скриншотов за один вызов (точка входа для пула процессов)"""
+    results = {
+        'likes': set(),
+        'comments': set(),
+        'errors': [],
+        'failed': []  # Номера нераспознанных изображений в пачке
+    }
+    
+    # Текст всей пачки распознается одним вызовом Tesseract
+    texts = image_processor.extract_texts(images)
+    
+    for i, text in enumerate(texts):
+        if text is None:
+            results['failed'].append(i)
+            results['errors'].append(f"OCR failed for image {i}")
+            continue
+        try:
+            result = image_processor._process_text(text, members_list)
+            results['likes'].update(result['likes'])
+            results['comments'].update(result['comments'])
+        except Exception as e:
+            results['failed'].append(i)
+            results['errors'].append(str(e))
+            logger.error(f"Error in batch processing: {e}")
+    
+    return results
\ No newline at end of file
@@ -1,10 +1,15 @@
 from datetime import datetime, timedelta
 from typing import List, Dict, Any
+import heapq
 import logging
 from ..database.gsheets import get_db
+from ..database.cache import cache_manager
 
 logger = logging.getLogger(__name__)
 
+# Время жизни кэша дневных сумм матсуни (секунды)
+DAILY_TOTALS_TTL = 60
+
 class MatsuniCalculator:
     """Калькулятор матсуни с поддержкой исключений"""
     
@@ -26,6 +31,9 @@ class MatsuniCalculator:
         exclusions = self.db.get_exclusions(post_name)
         excluded_users = {ex['username'] for ex in exclusions}
         
+        # Начисления за день читаются один раз на пост, а не на каждого участника
+        daily_totals = self._load_daily_totals(post_date)
+        
         results = []
         for activity in activities:
             username = activity.get('username', '')
@@ -48,7 +56,7 @@ class MatsuniCalculator:
                 matsuni = 0
             
             # Проверяем дневной лимит
-            daily_limit = self._check_daily_limit(username, post_date, matsuni)
+            daily_limit = self._check_daily_limit(username, daily_totals, matsuni)
             if daily_limit < matsuni:
                 logger.info(f"Daily limit for {username} on {post_date}: {daily_limit}")
                 matsuni = daily_limit
@@ -64,20 +72,34 @@ class MatsuniCalculator:
         
         return results
     
-    def _check_daily_limit(self, username: str, date: str, new_matsuni: int) -> int:
+    def _load_daily_totals(self, date: str) -> Dict[str, int]:
+        """Сумма матсуни каждого участника за день"""
+        # Отложенные строки Активности сначала отправляются в таблицу (это сбрасывает кэш)
+        flushed = self.db.flush('Активность')
+        
+        cache = cache_manager.get_cache('daily_totals', ttl=DAILY_TOTALS_TTL)
+        totals = cache.get(date)
+        if totals is None:
+            totals = self._sum_daily(self.db.get_activities(), date, {})
+            cache[date] = totals
+        
+        # Если запись не удалась, строки из очереди учитываются отдельно
+        if not flushed:
+            totals = self._sum_daily(self.db.pending_records('Активность'), date, dict(totals))
+        return totals
+    
+    def _sum_daily(self, rows: List[Dict], date: str, totals: Dict[str, int]) -> Dict[str, int]:
+        """Добавить к суммам матсуни строки активности за день"""
+        for row in rows:
+            activity_date = str(row['Время проверки']).split(' ', 1)[0]
+            if activity_date == date:
+                username = row['Username']
+                totals[username] = totals.get(username, 0) + int(row.get('Матсуни') or 0)
+        return totals
+    
+    def _check_daily_limit(self, username: str, daily_totals: Dict[str, int], new_matsuni: int) -> int:
         """Проверить дневной лимит"""
-        # Получаем все активности пользователя за эту дату
-        ws = self.db.get_worksheet('Активность')
-        data = ws.get_all_records()
-        
-        daily_total = 0
-        for row in data:
-            if row['Username'] == username:
-                activity_date = row['Время проверки'].split()[0]
-                if activity_date == date:
-                    daily_total += int(row.get('Матсуни', 0))
-        
-        remaining = self.rules['max_per_day'] - daily_total
+        remaining = self.rules['max_per_day'] - daily_totals.get(username, 0)
         return min(new_matsuni, max(0, remaining))
     
     def calculate_period_totals(self, start_date: str, end_date: str) -> Dict:
@@ -106,18 +128,18 @@ class MatsuniCalculator:
         """Сгенерировать рейтинги"""
         results = period_data['results']
         
-        # Топ по общему количеству матсуни
-        top_total = sorted(results, key=lambda x: x['total_matsuni'], reverse=True)[:10]
+        # Топ по общему количеству матсуни (частичная сортировка кучей)
+        top_total = heapq.nlargest(10, results, key=lambda x: x['total_matsuni'])
         
         # Топ по средней активности
-        top_avg = sorted(results, key=lambda x: x['avg_matsuni'], reverse=True)[:10]
+        top_avg = heapq.nlargest(10, results, key=lambda x: x['avg_matsuni'])
         
         # Топ по дням активности
-        top_days = sorted(results, key=lambda x: x['days_active'], reverse=True)[:10]
+        top_days = heapq.nlargest(10, results, key=lambda x: x['days_active'])
         
         # Самые стабильные (минимальное отклонение)
         if len(results) >= 3:
-            stable = sorted(results, key=lambda x: abs(x['avg_matsuni'] - 1))[:5]
+            stable = heapq.nsmallest(5, results, key=lambda x: abs(x['avg_matsuni'] - 1))
         else:
             stable = []
         
@@ -1,38 +1,74 @@
 # bot/utils/formatters.py
 
+# Максимальная длина сообщения Telegram (с запасом до лимита 4096)
+MAX_MESSAGE_LENGTH = 4000
+
 def format_report(results: dict) -> str:
     """Форматирование отчета"""
     if not results:
         return "Нет данных для отчета"
     
-    report = f"📊 *ОТЧЕТ ЗА ПЕРИОД*\n"
-    report += f"────────────────────\n"
-    report += f"📅 Период: {results.get('period', 'не указан')}\n"
-    report += f"👥 Участников: {results.get('total_members', 0)}\n"
-    report += f"💰 Всего матсуни: {results.get('total_matsuni', 0)}\n"
-    report += f"────────────────────\n"
-    report += f"🏆 *ТОП УЧАСТНИКОВ:*\n"
+    # Строки собираются в список и склеиваются один раз
+    lines = [
+        "📊 *ОТЧЕТ ЗА ПЕРИОД*",
+        "────────────────────",
+        f"📅 Период: {results.get('period', 'не указан')}",
+        f"👥 Участников: {results.get('total_members', 0)}",
+        f"💰 Всего матсуни: {results.get('total_matsuni', 0)}",
+        "────────────────────",
+        "🏆 *ТОП УЧАСТНИКОВ:*",
+    ]
     
     for i, res in enumerate(results.get('results', [])[:10], 1):
-        report += f"{i}. @{res['username']} - {res['total_matsuni']} матсуни "
-        report += f"({res['days_active']} дней)\n"
+        lines.append(f"{i}. @{res['username']} - {res['total_matsuni']} матсуни ({res['days_active']} дней)")
     
-    return report
+    return '\n'.join(lines) + '\n'
 
 def format_member_list(members: list) -> str:
     """Форматирование списка участников"""
     if not members:
         return "📭 Список участников пуст"
     
-    report = f"👥 *СПИСОК УЧАСТНИКОВ*\n"
-    report += f"────────────────────\n"
+    lines = [
+        "👥 *СПИСОК УЧАСТНИКОВ*",
+        "────────────────────",
+    ]
     
     for i, member in enumerate(members, 1):
         status = "✅" if member.get('status', '').lower() == 'активен' else "⏸️"
-        report += f"{i}. {status} @{member['username']} "
-        report += f"(с {member.get('join_date', '?')})\n"
+        lines.append(f"{i}. {status} @{member['username']} (с {member.get('join_date', '?')})")
+    
+    lines.append("────────────────────")
+    lines.append(f"Всего: {len(members)} участников")
+    
+    return '\n'.join(lines)
+
+def split_message(text: str, limit: int = MAX_MESSAGE_LENGTH,
+                  separators: tuple = ('\n\n', '\n')) -> list:
+    """Разбить длинное сообщение на части по абзацам, затем по строкам"""
+    if len(text) <= limit:
+        return [text]
+    if not separators:
+        return [text[i:i + limit] for i in range(0, len(text), limit)]
     
-    report += f"────────────────────\n"
-    report += f"Всего: {len(members)} участников"
+    sep, rest = separators[0], separators[1:]
+    parts = []
+    buf = ''
+    for chunk in text.split(sep):
+        if len(chunk) > limit:
+            # Слишком длинный блок делим по следующему разделителю
+            if buf:
+                parts.append(buf)
+                buf = ''
+            parts.extend(split_message(chunk, limit, rest))
+        elif not buf:
+            buf = chunk
+        elif len(buf) + len(sep) + len(chunk) <= limit:
+            buf += sep + chunk
+        else:
+            parts.append(buf)
+            buf = chunk
     
-    return report
\ No newline at end of file
+    if buf:
+        parts.append(buf)
+    return parts
\ No newline at end of file
@@ -1,7 +1,9 @@
 # bot/utils/validators.py
 import re
 from datetime import datetime
+from functools import lru_cache
 
+@lru_cache(maxsize=1024)
 def validate_date(date_str: str) -> bool:
     """Проверка даты в формате ГГГГ-ММ-ДД"""
     try:
@@ -10,6 +12,7 @@ def validate_date(date_str: str) -> bool:
     except ValueError:
         return False
 
+@lru_cache(maxsize=1024)
 def validate_username(username: str) -> bool:
     """Проверка формата username"""
     pattern = r'^[a-zA-Z0-9_.]+$'
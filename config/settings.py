@@ -48,6 +48,12 @@ CACHE_CONFIG = {
     'max_size': 1000,
 }
 
+# Состояние диалогов (сохраняется между перезапусками)
+STATE_FILE = DATA_DIR / 'matsuni_state.pkl'
+
+# Время жизни незавершенного диалога
+SESSION_TTL = timedelta(hours=1)
+
 # Логирование
 LOGGING_CONFIG = {
     'version': 1,
@@ -5,7 +5,7 @@ setup(
     version="1.0.0",
     python_requires=">=3.13",
     install_requires=[
-        "python-telegram-bot==21.7",
+        "python-telegram-bot[rate-limiter,job-queue]==21.7",
         "gspread==6.0.2",
         "google-auth==2.28.2",
         "pytesseract==0.3.13",
@@ -14,5 +14,7 @@ setup(
         "numpy==2.0.0",
         "Flask==3.0.3",
         "pandas==2.2.2",
+        "XlsxWriter==3.2.0",
+        "rapidfuzz==3.10.1",
     ],
 )
\ No newline at end of file
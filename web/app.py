@@ -1,23 +1,66 @@
+import asyncio
+import atexit
+import hmac
 import os
-from flask import Flask, jsonify
-from telegram.ext import Application
+import secrets
+import threading
+from flask import Flask, jsonify, request
+from telegram import Update
 
 app = Flask(__name__)
 
+# Публичный адрес сервера: если задан, бот получает обновления через webhook
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL")
+
+# Секрет, который Telegram присылает в заголовке каждого запроса webhook.
+# Сгенерированный секрет годится только для одного процесса сервера
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET") or secrets.token_hex(32)
+
 # Инициализация бота
 bot_app = None
+bot_loop = None
+_init_lock = threading.Lock()
 
 def init_bot():
-    """Инициализация Telegram бота"""
-    global bot_app
-    from config.settings import BOT_TOKEN
-    from bot.main import main
+    """Инициализация Telegram бота (только в режиме webhook)"""
+    global bot_app, bot_loop
+    from bot.main import build_application
     
-    if not bot_app:
-        bot_app = Application.builder().token(BOT_TOKEN).build()
+    with _init_lock:
+        if not bot_app:
+            # Приложение живет в собственном цикле событий в фоновом потоке,
+            # Flask только передает туда обновления
+            bot_loop = asyncio.new_event_loop()
+            threading.Thread(target=bot_loop.run_forever, daemon=True).start()
+            
+            application = build_application()
+            asyncio.run_coroutine_threadsafe(_start_application(application), bot_loop).result()
+            bot_app = application
+            
+            # Иначе при выходе теряется несохраненное состояние PicklePersistence
+            atexit.register(_stop_bot)
     
     return bot_app
 
+async def _start_application(application):
+    """Запуск обработки очереди обновлений"""
+    await application.initialize()
+    await application.start()
+    await application.bot.set_webhook(
+        f"{WEBHOOK_URL.rstrip('/')}/webhook",
+        secret_token=WEBHOOK_SECRET
+    )
+
+async def _stop_application(application):
+    """Остановка приложения с сохранением состояния"""
+    await application.stop()
+    await application.shutdown()
+
+def _stop_bot():
+    """Остановить приложение бота и его цикл событий"""
+    asyncio.run_coroutine_threadsafe(_stop_application(bot_app), bot_loop).result(timeout=30)
+    bot_loop.call_soon_threadsafe(bot_loop.stop)
+
 @app.route('/')
 def home():
     """Главная страница"""
@@ -39,9 +82,21 @@ def health_check():
 @app.route('/webhook', methods=['POST'])
 def webhook():
     """Webhook для Telegram"""
-    # Эта функция будет обрабатывать webhook от Telegram
-    # Пока возвращаем заглушку
-    return jsonify({"status": "webhook_received"}), 200
+    # В режиме polling второе приложение писало бы в тот же файл состояния
+    if not WEBHOOK_URL:
+        return jsonify({"error": "webhook mode is disabled"}), 404
+    
+    # Без проверки секрета поддельный запрос мог бы выдать себя за администратора
+    token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not hmac.compare_digest(token.encode(), WEBHOOK_SECRET.encode()):
+        return jsonify({"error": "forbidden"}), 403
+    
+    application = init_bot()
+    update = Update.de_json(request.get_json(force=True), application.bot)
+    
+    # Обработчики (в т.ч. OCR) выполняются в цикле бота: ответ Telegram их не ждет
+    asyncio.run_coroutine_threadsafe(application.update_queue.put(update), bot_loop)
+    return '', 200
 
 @app.route('/api/status')
 def api_status():
@@ -56,6 +111,11 @@ def api_status():
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+# В режиме webhook бот запускается при импорте: под WSGI-сервером __main__ не выполняется,
+# а без запуска webhook не будет зарегистрирован в Telegram
+if WEBHOOK_URL:
+    init_bot()
+
 def run_bot():
     """Запуск Telegram бота в отдельном потоке"""
     try:
@@ -68,10 +128,11 @@ def run_bot():
 if __name__ == '__main__':
     port = int(os.environ.get("PORT", 5000))
     
-    # Запускаем бот в отдельном потоке
-    import threading
-    bot_thread = threading.Thread(target=run_bot, daemon=True)
-    bot_thread.start()
+    # Бот работает в одном режиме: webhook (запущен выше), если задан WEBHOOK_URL, иначе polling
+    if not WEBHOOK_URL:
+        # Запускаем бот в отдельном потоке
+        bot_thread = threading.Thread(target=run_bot, daemon=True)
+        bot_thread.start()
     
     # Запускаем Flask сервер
     app.run(host='0.0.0.0', port=port)
\ No newline at end of file